@@ -30,4 +30,7 @@ setup(
     packages=find_packages("src"),
     package_dir={"": "src"},
     package_data={"redmill": ["static/*", "templates/*"]},
+    entry_points={
+        "console_scripts": ["redmill = redmill.command_line:main"]
+    },
 )
@@ -15,8 +15,15 @@
 
 from . import processor
 
+from . import cache
+from . import render
+from . import tasks
+
 from . import database
 from . import magic
+from . import upload
+from . import serializer
+from . import importer
 
 from . import models
 from . import views
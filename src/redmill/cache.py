@@ -0,0 +1,239 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+class Cache(object):
+    """ On-disk cache of rendered derivatives.
+
+        Entries are stored as <directory>/<media id>/<derivative id>-<key>,
+        where the key is a hash of the operations, of the modification time
+        of the source and of the rendering quality. The total size of the
+        cache is bounded by max_size (in bytes, None for no bound): when it is
+        exceeded, the least recently used entries are removed until the size
+        is below 90% of max_size.
+
+        The total size is tracked in memory, and the directory is only
+        walked when the bound is exceeded (which also accounts for the
+        entries written by other processes).
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+
+        # Estimated size of the entries, None until the directory is walked
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get(self, media_id, derivative_id, operations, mtime, quality="normal"):
+        """ Return the cached data, or None if it is not in the cache.
+        """
+
+        path = self._get_path(
+            media_id, derivative_id, operations, mtime, quality)
+        try:
+            with open(path, "rb") as fd:
+                data = fd.read()
+        except (IOError, OSError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return data
+
+    def contains(
+            self, media_id, derivative_id, operations, mtime,
+            quality="normal"):
+        """ Test whether the given entry is in the cache.
+        """
+
+        return os.path.isfile(self._get_path(
+            media_id, derivative_id, operations, mtime, quality))
+
+    def put(
+            self, media_id, derivative_id, operations, mtime, data,
+            quality="normal"):
+        """ Store the data in the cache, replacing the previous versions of the
+            derivative.
+        """
+
+        path = self._get_path(
+            media_id, derivative_id, operations, mtime, quality)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Concurrently created
+                if not os.path.isdir(directory):
+                    raise
+
+        # Write to a temporary file so that readers never see a partial entry.
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as stream:
+                stream.write(data)
+            os.rename(temporary, path)
+        except:
+            os.remove(temporary)
+            raise
+
+        removed = self._remove(media_id, derivative_id, keep=path)
+        self._update_size(len(data)-removed)
+        if self.max_size is not None and (
+                self._size is None or self._size > self.max_size):
+            self._evict()
+
+    def invalidate(self, media_id, derivative_id=None):
+        """ Remove the entries of a derivative or, if derivative_id is None, of
+            all the derivatives of the media.
+        """
+
+        if derivative_id is None:
+            self.remove_detached(
+                os.path.join(self.directory, "{}".format(media_id)))
+        else:
+            self._update_size(-self._remove(media_id, derivative_id))
+
+    def detach(self, media_id):
+        """ Move the entries of all the derivatives of the media out of the
+            way, so that they are not visible to a new media with the same id,
+            and return their directory (None if the media has no entries). The
+            entries must then be removed by remove_detached.
+        """
+
+        directory = os.path.join(self.directory, "{}".format(media_id))
+        detached = os.path.join(
+            self.directory, ".deleted-{}".format(uuid.uuid4().hex))
+        try:
+            os.rename(directory, detached)
+        except OSError:
+            return None
+        return detached
+
+    def remove_detached(self, directory):
+        """ Remove a directory of entries, e.g. returned by detach.
+        """
+
+        removed = 0
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                removed += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+        shutil.rmtree(directory, True)
+        self._update_size(-removed)
+
+    def clear(self):
+        """ Remove all entries.
+        """
+
+        shutil.rmtree(self.directory, True)
+        with self._lock:
+            self._size = 0
+
+    def _get_path(self, media_id, derivative_id, operations, mtime, quality):
+        key = hashlib.sha1(json.dumps(
+            [operations, mtime, quality], sort_keys=True).encode("utf-8"))
+        return os.path.join(
+            self.directory, "{}".format(media_id),
+            "{}-{}".format(derivative_id, key.hexdigest()))
+
+    def _remove(self, media_id, derivative_id, keep=None):
+        """ Remove all versions of a derivative, except keep, and return the
+            number of removed bytes.
+        """
+
+        directory = os.path.join(self.directory, "{}".format(media_id))
+        prefix = "{}-".format(derivative_id)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return 0
+
+        removed = 0
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.startswith(prefix) and path != keep:
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    pass
+                else:
+                    removed += size
+        return removed
+
+    def _update_size(self, delta):
+        """ Update the estimated size of the cache, if it is known.
+        """
+
+        with self._lock:
+            if self._size is not None:
+                self._size += delta
+
+    def _evict(self):
+        """ Walk the cache and remove the least recently used entries until
+            its size is below 90% of its maximum size.
+        """
+
+        if self.max_size is None:
+            return
+
+        target = self.max_size - self.max_size//10
+
+        entries = []
+        size = 0
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith("."):
+                    # Entry being written
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                size += stat.st_size
+
+        if size > self.max_size:
+            entries.sort()
+            for _, entry_size, path in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= entry_size
+
+        with self._lock:
+            self._size = size
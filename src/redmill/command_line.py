@@ -0,0 +1,134 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import sys
+
+import sqlalchemy
+
+from . import database, importer, models
+
+def upgrade(arguments):
+    """ Upgrade the schema of the database and compute the derived data of
+        the new columns.
+    """
+
+    engine = sqlalchemy.create_engine(arguments.database)
+    database.upgrade(engine, models.Base.metadata)
+    update_paths(arguments)
+    update_visibility(arguments)
+    if arguments.media_directory is not None:
+        update_content_info(arguments)
+
+def update_paths(arguments):
+    """ Compute the materialized paths of all items.
+    """
+
+    engine = sqlalchemy.create_engine(arguments.database)
+    with engine.begin() as connection:
+        modified = models.item.update_paths(connection)
+    print("{} path(s) updated".format(modified))
+
+def update_visibility(arguments):
+    """ Compute the visibility of all items.
+    """
+
+    engine = sqlalchemy.create_engine(arguments.database)
+    with engine.begin() as connection:
+        modified = models.item.update_visibility(connection)
+    print("{} visibility flag(s) updated".format(modified))
+
+def update_content_info(arguments):
+    """ Compute the MIME type, size, dimensions and hash of all media.
+    """
+
+    engine = sqlalchemy.create_engine(arguments.database)
+    with engine.begin() as connection:
+        modified = models.media.update_content_info(
+            connection, arguments.media_directory)
+    print("{} content information(s) updated".format(modified))
+
+def import_(arguments):
+    """ Import the files of a directory as albums and media.
+    """
+
+    engine = sqlalchemy.create_engine(arguments.database)
+    session = database.Session(bind=engine)
+
+    def progress(imported, total):
+        print("{}/{} media imported".format(imported, total))
+        sys.stdout.flush()
+
+    try:
+        importer.import_files(
+            session, arguments.media_directory, arguments.source,
+            importer.scan(arguments.source), arguments.parent_id,
+            arguments.author, arguments.link, arguments.batch_size,
+            arguments.workers, progress)
+    finally:
+        session.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage a Redmill database")
+    subparsers = parser.add_subparsers()
+
+    parsers = {}
+    for function in [
+            upgrade, update_paths, update_visibility, update_content_info]:
+        subparser = subparsers.add_parser(
+            function.__name__.replace("_", "-"),
+            help=function.__doc__.split(".")[0].strip())
+        subparser.add_argument(
+            "database", help="Database URL, e.g. sqlite:////some/where.db")
+        subparser.set_defaults(function=function)
+        parsers[function] = subparser
+
+    parsers[upgrade].add_argument(
+        "--media-directory",
+        help="Directory of the media, to compute their content information")
+    parsers[update_content_info].add_argument(
+        "media_directory", help="Directory of the media")
+
+    subparser = subparsers.add_parser(
+        "import", help=import_.__doc__.split(".")[0].strip())
+    subparser.add_argument(
+        "database", help="Database URL, e.g. sqlite:////some/where.db")
+    subparser.add_argument("media_directory", help="Directory of the media")
+    subparser.add_argument("source", help="Directory of the files to import")
+    subparser.add_argument(
+        "--parent-id", type=int,
+        help="Album receiving the files (default: top-level)")
+    subparser.add_argument("--author", default=u"", help="Author of the media")
+    subparser.add_argument(
+        "--link", action="store_true",
+        help="Hard-link the files instead of copying them")
+    subparser.add_argument(
+        "--batch-size", type=int, default=500,
+        help="Number of media per transaction (default: %(default)s)")
+    subparser.add_argument(
+        "--workers", type=int,
+        help="Number of hashing processes (default: number of CPUs)")
+    subparser.set_defaults(function=import_)
+
+    arguments = parser.parse_args(argv)
+    if not hasattr(arguments, "function"):
+        parser.print_help()
+        return 1
+
+    arguments.function(arguments)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
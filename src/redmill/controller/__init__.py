@@ -23,9 +23,42 @@ from . import register
 from .. import views
 
 app = flask.Flask("redmill")
+app.request_class = views.Request
 app.config["authenticator"] = None
 app.config["max_token_age"] = 3600
+# Directory of the files imported by POST /import, None to disable it
+app.config["import_directory"] = None
+# Number of processes computing the hashes of imported files (0 to compute
+# them in the request, None for the number of CPUs). The processes are created
+# for each import.
+app.config["import_workers"] = 0
+# Maximum number of ids in a batch request (e.g. GET /media/?ids=1,2,3)
+app.config["max_batch_size"] = 500
 app.config["media_directory"] = None
+# Directory of the rendered derivatives (default: "cache" in media_directory)
+app.config["cache_directory"] = None
+# Maximum size of the cached derivatives in bytes, None for no limit
+app.config["cache_size"] = 512*1024*1024
+# Queue used to render derivatives in the background
+app.config["render_queue"] = redmill.tasks.ThreadQueue()
+# Executor of the rendering jobs, use redmill.render.ProcessExecutor to render
+# in worker processes
+app.config["render_executor"] = redmill.render.LocalExecutor()
+# Quality of the rendered derivatives ("low", "normal" or "high"), lower
+# qualities downscale faster
+app.config["render_quality"] = "normal"
+# Cache-Control header of media and derivative contents
+app.config["cache_control"] = "no-cache"
+# Let the fronting server send the media files: None, "X-Sendfile" or
+# "X-Accel-Redirect". In the latter case, sendfile_prefix is the internal
+# location of media_directory.
+app.config["sendfile"] = None
+app.config["sendfile_prefix"] = "/media_directory"
+# Cache of the album tree shared between processes (e.g. a cachelib cache),
+# None to only cache it in each process
+app.config["tree_cache"] = None
+# Use orjson, if installed, to serialize JSON responses
+app.config["fast_json"] = True
 app.config["serializer"] = lambda: itsdangerous.URLSafeTimedSerializer(
     app.config["SECRET_KEY"], "token")
 app.json_encoder = JSONEncoder
@@ -52,6 +85,8 @@ app.add_url_rule(
 
 
 register.register_collection(app, views.media, "/media")
+app.add_url_rule(
+    "/media/", "media.get_many", views.media.get_many, methods=["GET"])
 app.add_url_rule(
     "/albums/<int:parent_id>/create_media", "media.create", views.media.create,
     methods=["GET"])
@@ -69,7 +104,14 @@ app.add_url_rule(
     "/media/<int:media_id>/derivative/<int:derivative_id>/content",
     "derivative.content", views.derivative.get_content, methods=["GET"])
 
+register.register_collection(app, views.upload_session, "/uploads")
+app.add_url_rule(
+    "/uploads/<int:id_>/finalize", "upload_session.finalize",
+    views.upload_session.finalize, methods=["POST"])
+
+register.register_item(app, views.importer, "/import")
 register.register_item(app, views.token, "/token")
+register.register_item(app, views.render_queue, "/render_queue")
 
 @app.context_processor
 def inject_user():
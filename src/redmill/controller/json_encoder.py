@@ -16,7 +16,7 @@
 import datetime
 import flask
 import flask.json
-from .. import models, views
+from .. import database, models, serializer, views
 
 class JSONEncoder(flask.json.JSONEncoder):
     """ Encode database objects to JSON.
@@ -29,7 +29,9 @@ class JSONEncoder(flask.json.JSONEncoder):
                     "id", "name", "parent_id", "status", "created_at",
                     "modified_at"],
                 models.Album: [],
-                models.Media: ["author", "keywords", "filename"]
+                models.Media: [
+                    "author", "keywords", "filename", "mime_type", "size",
+                    "width", "height", "content_hash"]
             }
 
             type_ = type(obj)
@@ -39,14 +41,32 @@ class JSONEncoder(flask.json.JSONEncoder):
             value["type"] = type_.__name__
 
             if isinstance(obj, models.Album):
-                children = [(x.type, x.id) for x in obj.children]
+                if getattr(obj, "child_rows", None) is not None:
+                    # Children fetched as (type, id) rows
+                    children = obj.child_rows
+                elif "children" in obj.__dict__ or obj.id is None:
+                    # Already loaded (or filtered) children
+                    children = [(x.type, x.id) for x in obj.children]
+                else:
+                    # Only the type and id of the children are needed
+                    children = database.Session()\
+                        .query(models.Item.type, models.Item.id)\
+                        .filter_by(parent_id=obj.id)\
+                        .order_by(models.Item.rank, models.Item.id)\
+                        .all()
 
-                value["children"] = [
-                    flask.url_for("{}.get".format(collection), id_=id_)
-                    for collection, id_ in children]
+                value["children"] = serializer.get_item_urls(children)
         elif isinstance(obj, models.Derivative):
             fields = ["media_id", "id", "operations"]
             value = { field: getattr(obj, field) for field in fields }
+            if flask.has_app_context():
+                value["warm"] = views.derivative.is_warm(obj)
+        elif isinstance(obj, models.UploadSession):
+            fields = [
+                "id", "size", "name", "author", "keywords", "parent_id",
+                "created_at", "complete"]
+            value = { field: getattr(obj, field) for field in fields }
+            value["received"] = [list(x) for x in obj.received]
         elif isinstance(obj, datetime.datetime):
             value = obj.isoformat()
         else:
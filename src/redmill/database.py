@@ -13,10 +13,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
 import mimetypes
 import os
 
+import PIL.Image
 import sqlalchemy
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
@@ -28,22 +30,86 @@ from . import magic
 Base = sqlalchemy.ext.declarative.declarative_base()
 Session = sqlalchemy.orm.sessionmaker()
 
-def get_filesystem_path(name, data=None):
-    if data:
+def get_filesystem_path(name, data=None, mime_type=None):
+    if data and not mime_type:
         mime_type = magic.buffer(data).decode("utf-8")
 
+    if mime_type:
         blacklist = [".jpe", ".jpeg"]
         suffix_map = {
             type_: suffix
             for suffix, type_ in mimetypes.types_map.items()
             if suffix not in blacklist
         }
-        extension = suffix_map[mime_type]
+        extension = suffix_map.get(mime_type, "")
     else:
         extension = ""
 
     return "{}{}".format(unidecode.unidecode(name.replace(" ", "_")), extension)
 
+def get_content_info(path, chunk_size=65536):
+    """ Return the MIME type, size, pixel dimensions (None if the file is not
+        an image) and SHA-256 hash of a file.
+    """
+
+    mime_type = None
+    size = 0
+    hash_ = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while True:
+            data = fd.read(chunk_size)
+            if mime_type is None:
+                # The beginning of the file is enough to guess its type
+                mime_type = magic.buffer(data).decode("utf-8")
+            if not data:
+                break
+            size += len(data)
+            hash_.update(data)
+
+    width, height = get_image_size(path)
+
+    return {
+        "mime_type": mime_type, "size": size, "width": width, "height": height,
+        "content_hash": hash_.hexdigest()
+    }
+
+def get_image_size(path):
+    """ Return the pixel dimensions of an image file, or (None, None) if the
+        file is not an image.
+    """
+
+    try:
+        # Only the header is read
+        with PIL.Image.open(path) as image:
+            return image.size
+    except Exception:
+        return None, None
+
+def upgrade(engine, metadata):
+    """ Upgrade the schema of an existing database: create the missing tables
+        and add the missing columns and indexes of the existing tables.
+    """
+
+    metadata.create_all(engine)
+
+    inspector = sqlalchemy.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            columns = set(x["name"] for x in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                connection.execute(sqlalchemy.text(
+                    "ALTER TABLE {} ADD COLUMN {} {}".format(
+                        quote(table.name), quote(column.name),
+                        column.type.compile(dialect=engine.dialect))))
+
+            indexes = set(x["name"] for x in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+
 class JSON(sqlalchemy.types.TypeDecorator):
 
     impl = sqlalchemy.types.String
@@ -52,4 +118,4 @@ class JSON(sqlalchemy.types.TypeDecorator):
         return json.dumps(value)
 
     def process_result_value(self, value, dialect):
-        return json.loads(value)
+        return json.loads(value) if value is not None else None
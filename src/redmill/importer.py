@@ -0,0 +1,239 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Bulk import of files as albums and media, bypassing the HTTP upload.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+
+from . import database, models
+
+def scan(directory):
+    """ Return the entries of the files below directory (cf. import_files),
+        sorted by path. Hidden files and directories are skipped.
+    """
+
+    entries = []
+    for root, directories, files in os.walk(directory):
+        directories[:] = sorted(x for x in directories if not x.startswith("."))
+        for name in sorted(files):
+            if not name.startswith("."):
+                path = os.path.relpath(os.path.join(root, name), directory)
+                entries.append({"path": path})
+    return entries
+
+def import_files(
+        session, media_directory, root, entries, parent_id=None, author=u"",
+        link=False, batch_size=500, workers=None, progress=None):
+    """ Import files in the database and in the media directory.
+
+        Each entry is a dictionary with the "path" of the file, relative to
+        root, and optionally its "name" (default to the file name), "author"
+        (default to author) and "keywords". The directories of the paths
+        become albums below parent_id (None for the top-level); existing
+        albums with the same name are re-used.
+
+        Media are inserted in transactions of batch_size media, and their
+        files are copied to the media directory or, if link is True,
+        hard-linked when possible. The MIME types, dimensions and hashes are
+        computed by a pool of workers processes (default to the number of
+        CPUs, 0 to compute them in the calling process). If not None,
+        progress is called after each transaction with the number of imported
+        media and the total number of media.
+
+        Return the ids of the new media, in the order of the entries. Raise
+        ValueError if a file is missing or outside root, if the parent album
+        does not exist or if a media would be at the top-level.
+    """
+
+    paths = [_get_relative_path(entry["path"]) for entry in entries]
+    sources = [os.path.join(root, x) for x in paths]
+    for source in sources:
+        if not os.path.isfile(source):
+            raise ValueError("No such file: {}".format(source))
+
+    if parent_id is None:
+        if any(not os.path.dirname(x) for x in paths):
+            raise ValueError("Only albums are allowed at the top-level")
+    elif session.query(models.Album).get(parent_id) is None:
+        raise ValueError("No such album: {}".format(parent_id))
+
+    albums = _get_albums(
+        session, parent_id, [os.path.dirname(x) for x in paths])
+    session.commit()
+
+    # Path and visibility of each album, so that the media do not query them
+    # on insert (cf. Item.compute_path)
+    parents = {None: ("/", True)}
+    table = models.Item.__table__
+    rows = session.execute(
+        sqlalchemy.select([table.c.id, table.c.path, table.c.visible])\
+            .where(table.c.id.in_(
+                [x for x in albums.values() if x is not None])))
+    for id_, path, visible in rows:
+        parents[id_] = (path, visible)
+    set_path = table.update()\
+        .where(table.c.id == sqlalchemy.bindparam("id_"))\
+        .values(path=sqlalchemy.bindparam("path_"))
+
+    # Next rank in each album
+    ranks = {}
+
+    pool = None
+    if workers == 0:
+        infos = (database.get_content_info(x) for x in sources)
+    else:
+        pool = multiprocessing.Pool(workers)
+        infos = pool.imap(database.get_content_info, sources, 16)
+
+    ids = []
+    try:
+        for start in range(0, len(entries), batch_size):
+            batch = list(range(start, min(start+batch_size, len(entries))))
+
+            media = []
+            for index in batch:
+                entry, path = entries[index], paths[index]
+
+                album_id = albums[os.path.dirname(path)]
+                if album_id not in ranks:
+                    ranks[album_id] = session.query(models.Item)\
+                        .filter_by(parent_id=album_id).count()
+
+                item = models.Media(
+                    name=entry.get("name", os.path.basename(path)),
+                    author=entry.get("author", author),
+                    keywords=entry.get("keywords"),
+                    parent_id=album_id, rank=ranks[album_id],
+                    visible=parents[album_id][1])
+                item.compute_path = (parents[album_id][0] is None)
+                item.set_content_info(next(infos))
+                item.filename = database.get_filesystem_path(
+                    item.name, mime_type=item.mime_type)
+                media.append(item)
+
+                ranks[album_id] += 1
+
+            session.add_all(media)
+            session.flush()
+            batch_ids = [x.id for x in media]
+            batch_paths = [
+                {
+                    "id_": x.id,
+                    "path_": "{}{}/".format(parents[x.parent_id][0], x.id)}
+                for x in media if not x.compute_path]
+            if batch_paths:
+                session.execute(set_path, batch_paths)
+
+            destinations = []
+            try:
+                for index, id_ in zip(batch, batch_ids):
+                    destination = os.path.join(
+                        media_directory, "{}".format(id_))
+                    _place(sources[index], destination, link)
+                    destinations.append(destination)
+                session.commit()
+            except:
+                session.rollback()
+                for destination in destinations:
+                    try:
+                        os.remove(destination)
+                    except OSError:
+                        pass
+                raise
+
+            # Keep the session small
+            session.expunge_all()
+
+            ids.extend(batch_ids)
+            if progress is not None:
+                progress(len(ids), len(entries))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return ids
+
+def _get_relative_path(path):
+    """ Return the normalized form of a path relative to the import root, or
+        raise ValueError if it is outside the root.
+    """
+
+    normalized = os.path.normpath(path)
+    if (
+            os.path.isabs(normalized) or normalized == os.pardir
+            or normalized.startswith(os.pardir+os.sep)):
+        raise ValueError("Invalid path: {}".format(path))
+    return normalized
+
+def _get_albums(session, parent_id, directories):
+    """ Return the ids of the albums of each directory (relative paths, ""
+        being parent_id), creating the missing ones.
+    """
+
+    albums = {"": parent_id}
+    for directory in sorted(set(directories)):
+        names = directory.split(os.sep) if directory else []
+        for length in range(1, len(names)+1):
+            path = os.sep.join(names[:length])
+            if path in albums:
+                continue
+
+            album_parent_id = albums[os.sep.join(names[:length-1])]
+            album_id = session.query(models.Album.id)\
+                .filter_by(parent_id=album_parent_id, name=names[length-1])\
+                .order_by(models.Album.id)\
+                .limit(1).scalar()
+            if album_id is None:
+                rank = session.query(models.Item)\
+                    .filter_by(parent_id=album_parent_id).count()
+                album = models.Album(
+                    name=names[length-1], parent_id=album_parent_id, rank=rank)
+                session.add(album)
+                session.flush()
+                album_id = album.id
+            albums[path] = album_id
+
+    return albums
+
+def _place(source, destination, link):
+    """ Hard-link (if link is True) or copy the source file to destination,
+        without partial files at destination.
+    """
+
+    if link:
+        try:
+            os.link(source, destination)
+        except OSError:
+            # e.g. different file systems or existing destination: copy
+            pass
+        else:
+            return
+
+    fd, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(destination), prefix=".upload-")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, temporary)
+        os.rename(temporary, destination)
+    except:
+        os.remove(temporary)
+        raise
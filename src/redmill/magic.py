@@ -14,6 +14,7 @@
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
 import ctypes
+import ctypes.util
 
 def buffer(str_):
     _initialize()
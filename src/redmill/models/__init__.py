@@ -6,3 +6,5 @@ from .item import Item
 from .album import Album
 from .media import Media
 from .derivative import Derivative
+from .upload_session import UploadSession, UploadChunk
+from .tree_version import TreeVersion
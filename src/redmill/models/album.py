@@ -30,14 +30,20 @@ class Album(Item):
     __mapper_args__ = { "polymorphic_identity": "album" }
 
     @staticmethod
-    def get_toplevel():
-        session = redmill.database.Session()
-        album = Album(
-            id=None, name="Gallery root", parent_id=None,
-            children=session.query(Album)\
+    def get_toplevel(with_children=True):
+        """ Return a dummy album whose children are the top-level albums.
+        """
+
+        if with_children:
+            session = redmill.database.Session()
+            children = session.query(Album)\
                 .filter_by(parent_id=None)\
                 .order_by(Album.rank)\
-                .all())
+                .all()
+        else:
+            children = []
+        album = Album(
+            id=None, name="Gallery root", parent_id=None, children=children)
         return album
 
 Item.sub_types.append(Album)
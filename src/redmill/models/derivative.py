@@ -14,6 +14,7 @@
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
 
 import redmill.database
@@ -36,24 +37,17 @@ class Derivative(Base):
 
     def __init__(self, media, operations, id_=None):
         """ Operations must be a list of (operation_type, parameters). Media
-            can be media or its id.
+            can be media or its id. If id_ is None, the id is allocated when
+            the derivative is inserted.
         """
 
         if isinstance(media, Media):
             media_id = media.id
         else:
             media_id = media
-            session = redmill.database.Session()
-            media = session.query(Media).filter_by(id=media_id)
-
-        if id_ is None:
-            session = redmill.database.Session()
-            id_ = media.next_derivative
-            media.next_derivative += 1
-            session.commit()
 
         for type_, parameters in operations:
-            if type_ not in dir(redmill.processor):
+            if type_ not in redmill.processor.Operations:
                 raise NotImplementedError("Unknown operation: {}".format(type_))
 
         Base.__init__(self, media_id=media_id, id=id_, operations=operations)
@@ -68,3 +62,26 @@ class Derivative(Base):
         """
 
         return redmill.processor.apply(self.operations, image)
+
+@sqlalchemy.event.listens_for(Derivative, "before_insert")
+def _allocate_id(mapper, connection, target):
+    """ Allocate the id of a new derivative in the transaction of the insert.
+        The update locks the media row until the end of the transaction, so
+        that concurrent insertions get distinct ids.
+    """
+
+    if target.id is not None:
+        return
+
+    media = Media.__table__
+    connection.execute(
+        media.update()\
+            .where(media.c.id == target.media_id)\
+            .values(next_derivative=
+                sqlalchemy.func.coalesce(media.c.next_derivative, 1)+1))
+    next_derivative = connection.execute(
+        sqlalchemy.select([media.c.next_derivative])\
+            .where(media.c.id == target.media_id)).scalar()
+    if next_derivative is None:
+        raise ValueError("No such media: {}".format(target.media_id))
+    target.id = next_derivative-1
@@ -13,10 +13,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import datetime
 
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
+import sqlalchemy.orm.attributes
+
+import redmill.database
 
 from . import Base
 
@@ -32,20 +37,40 @@ class Item(Base):
 
     parent_id = sqlalchemy.Column(
         sqlalchemy.Integer, sqlalchemy.ForeignKey("item.id"))
+    # Materialized path: ids of the ancestors and of the item, e.g. "/1/5/12/".
+    # Maintained on insert and move, None if not computed (cf. update_paths).
+    path = sqlalchemy.Column(sqlalchemy.String, index=True)
 
     Status = ("published", "archived")
     status = sqlalchemy.Column(sqlalchemy.Enum(*Status), default="published")
+    # Whether the item and all its ancestors are published. Maintained on
+    # insert, status change and move, None if unknown (cf. update_visibility).
+    visible = sqlalchemy.Column(sqlalchemy.Boolean)
+
+    # Whether the path is computed on insert. Bulk inserts which compute it
+    # from the path of the parent disable this (cf. redmill.importer).
+    compute_path = True
 
     created_at = sqlalchemy.Column(
         sqlalchemy.DateTime, default=lambda: datetime.datetime.now())
     modified_at = sqlalchemy.Column(
         sqlalchemy.DateTime, nullable=True)
 
+    # Loaded on access: use loader options (e.g. selectinload) or explicit
+    # queries where more than one level is needed.
     children = sqlalchemy.orm.relationship(
-        "Item", lazy="immediate", order_by="asc(Item.rank)")
+        "Item", lazy="select", order_by="asc(Item.rank)")
 
     __mapper_args__ = { "polymorphic_identity": "item", "polymorphic_on": type }
 
+    __table_args__ = (
+        # Pages of children (get_album)
+        sqlalchemy.Index(
+            "ix_item_parent_id_status_rank", parent_id, status, rank, id),
+        # All children, in order (get_toplevel, order_children)
+        sqlalchemy.Index("ix_item_parent_id_rank", parent_id, rank, id),
+    )
+
     def __hash__(self):
         return hash(str(self.id)+self.type)
     
@@ -62,13 +87,382 @@ class Item(Base):
 
         return parent
 
+    def is_visible(self):
+        """ Test whether the item and all its ancestors are published.
+        """
+
+        if self.visible is not None:
+            return self.visible
+        else:
+            return all(x.status == "published" for x in self.parents+[self])
+
     def _get_parents(self):
-        current = self
-        parents = []
-        while current.parent_id is not None:
-            parents.insert(0, current.parent)
-            current = current.parent
-        return parents
+        """ Return the ancestors of the item, from the top-level one to the
+            direct parent, using a single recursive query.
+        """
+
+        if self.parent_id is None:
+            return []
+
+        session = sqlalchemy.orm.object_session(self)
+        if session is None:
+            session = redmill.database.Session()
+
+        item = sqlalchemy.orm.with_polymorphic(Item, Item.sub_types)
+        query = session.query(item)
+
+        ids = [int(x) for x in (self.path or "").split("/") if x][:-1]
+        if ids and ids[-1] == self.parent_id:
+            parents = {x.id: x for x in query.filter(item.id.in_(ids))}
+            if len(parents) == len(ids):
+                return [parents[x] for x in ids]
+
+        # No path (or an outdated one): walk up the hierarchy
+        ancestors = session.query(
+                Item.id, Item.parent_id, sqlalchemy.literal(0).label("depth"))\
+            .filter(Item.id == self.parent_id)\
+            .cte("ancestors", recursive=True)
+        parent = sqlalchemy.orm.aliased(Item)
+        ancestors = ancestors.union_all(
+            session.query(parent.id, parent.parent_id, ancestors.c.depth+1)\
+                .filter(parent.id == ancestors.c.parent_id))
+
+        return query\
+            .join(ancestors, item.id == ancestors.c.id)\
+            .order_by(ancestors.c.depth.desc())\
+            .all()
+
+    def get_descendants(self):
+        """ Return a query of the descendants of the item, deepest ones first.
+        """
+
+        session = sqlalchemy.orm.object_session(self)
+        if session is None:
+            session = redmill.database.Session()
+
+        item = sqlalchemy.orm.with_polymorphic(Item, Item.sub_types)
+        query = session.query(item)
+
+        if self.path is not None:
+            return query\
+                .filter(_get_path_range(item.path, self.path))\
+                .filter(item.id != self.id)\
+                .order_by(sqlalchemy.func.length(item.path).desc())
+
+        # No path: walk down the hierarchy
+        descendants = session.query(
+                Item.id, sqlalchemy.literal(0).label("depth"))\
+            .filter(Item.parent_id == self.id)\
+            .cte("descendants", recursive=True)
+        child = sqlalchemy.orm.aliased(Item)
+        descendants = descendants.union_all(
+            session.query(child.id, descendants.c.depth+1)\
+                .filter(child.parent_id == descendants.c.id))
+
+        return query\
+            .join(descendants, item.id == descendants.c.id)\
+            .order_by(descendants.c.depth.desc())
+
+    def delete_tree(self, chunk_size=500):
+        """ Delete the item, its descendants, their derivatives and their
+            pending uploads with bulk statements, without loading them. Return
+            the ids of the deleted media and of the deleted upload sessions.
+        """
+
+        session = sqlalchemy.orm.object_session(self)
+        tables = Base.metadata.tables
+        item = tables["item"]
+
+        if self.path is not None:
+            rows = session.execute(
+                sqlalchemy.select([item.c.id, item.c.type])\
+                    .where(_get_path_range(item.c.path, self.path))\
+                    .order_by(sqlalchemy.func.length(item.c.path).desc()))
+        else:
+            descendants = session.query(
+                    Item.id, sqlalchemy.literal(0).label("depth"))\
+                .filter(Item.id == self.id)\
+                .cte("descendants", recursive=True)
+            child = sqlalchemy.orm.aliased(Item)
+            descendants = descendants.union_all(
+                session.query(child.id, descendants.c.depth+1)\
+                    .filter(child.parent_id == descendants.c.id))
+            rows = session.query(Item.id, Item.type)\
+                .join(descendants, Item.id == descendants.c.id)\
+                .order_by(descendants.c.depth.desc())
+        # Deepest items first, so that no item is deleted before its children
+        rows = [tuple(x) for x in rows]
+
+        media = [id_ for id_, type_ in rows if type_ == "media"]
+        uploads = []
+
+        for begin in range(0, len(rows), chunk_size):
+            ids = [id_ for id_, _ in rows[begin:begin+chunk_size]]
+
+            upload_ids = [
+                x for x, in session.execute(
+                    sqlalchemy.select([tables["upload_session"].c.id])\
+                        .where(tables["upload_session"].c.parent_id.in_(ids)))]
+            if upload_ids:
+                session.execute(
+                    tables["upload_chunk"].delete()\
+                        .where(tables["upload_chunk"].c.upload_id.in_(upload_ids)))
+                session.execute(
+                    tables["upload_session"].delete()\
+                        .where(tables["upload_session"].c.id.in_(upload_ids)))
+                uploads.extend(upload_ids)
+
+            session.execute(
+                tables["derivative"].delete()\
+                    .where(tables["derivative"].c.media_id.in_(ids)))
+            for name in ["media", "album", "item"]:
+                session.execute(
+                    tables[name].delete().where(tables[name].c.id.in_(ids)))
+
+        if any(type_ == "album" for _, type_ in rows):
+            redmill.models.tree_version.increment_generation(
+                session.connection())
+
+        session.expunge(self)
+
+        return media, uploads
 
     parent = property(_get_parent)
     parents = property(_get_parents)
+
+def _get_path(connection, id_, parent_id):
+    """ Return the materialized path of an item, or None if the path of its
+        parent is unknown.
+    """
+
+    if parent_id is None:
+        return "/{}/".format(id_)
+
+    table = Item.__table__
+    parent_path = connection.execute(
+        sqlalchemy.select([table.c.path]).where(table.c.id == parent_id)
+    ).scalar()
+    if parent_path is None:
+        return None
+    return "{}{}/".format(parent_path, id_)
+
+def _get_visibility(connection, status, parent_id):
+    """ Return whether an item is visible, or None if the visibility of its
+        parent is unknown.
+    """
+
+    if status not in [None, "published"]:
+        return False
+    elif parent_id is None:
+        return True
+
+    table = Item.__table__
+    return connection.execute(
+        sqlalchemy.select([table.c.visible]).where(table.c.id == parent_id)
+    ).scalar()
+
+def _get_path_range(column, path):
+    """ Return the condition selecting the paths starting with path. This is a
+        range rather than a LIKE, so that the index of the paths is used: "0"
+        is the character following "/".
+    """
+
+    return sqlalchemy.and_(column >= path, column < "{}0".format(path[:-1]))
+
+def _get_subtree(id_, path):
+    """ Return the condition selecting an item and its descendants.
+    """
+
+    table = Item.__table__
+    if path is not None:
+        return _get_path_range(table.c.path, path)
+
+    descendants = sqlalchemy.select([table.c.id])\
+        .where(table.c.id == id_)\
+        .cte("descendants", recursive=True)
+    child = table.alias()
+    descendants = descendants.union_all(
+        sqlalchemy.select([child.c.id])\
+            .where(child.c.parent_id == descendants.c.id))
+    return table.c.id.in_(sqlalchemy.select([descendants.c.id]))
+
+@sqlalchemy.event.listens_for(Item, "before_insert", propagate=True)
+def _set_rank(mapper, connection, target):
+    """ Place the new items after their siblings, unless their rank is given,
+        so that the ranks stay 0..n-1.
+    """
+
+    if target.rank is not None:
+        return
+
+    table = Item.__table__
+    rank = sqlalchemy.func.coalesce(sqlalchemy.func.max(table.c.rank)+1, 0)
+    target.rank = connection.execute(
+        sqlalchemy.select([rank]).where(table.c.parent_id == target.parent_id)
+    ).scalar()
+
+@sqlalchemy.event.listens_for(Item, "after_insert", propagate=True)
+def _set_path(mapper, connection, target):
+    """ Set the path and the visibility of the new items, unless they are
+        already known (cf. Item.compute_path).
+    """
+
+    values = {}
+    if target.compute_path:
+        values["path"] = _get_path(connection, target.id, target.parent_id)
+    if target.visible is None:
+        values["visible"] = _get_visibility(
+            connection, target.status, target.parent_id)
+    if not values:
+        return
+
+    table = Item.__table__
+    connection.execute(
+        table.update()\
+            .where(table.c.id == target.id)\
+            .values(**values))
+    for name, value in values.items():
+        sqlalchemy.orm.attributes.set_committed_value(target, name, value)
+
+@sqlalchemy.event.listens_for(Item, "after_update", propagate=True)
+def _update_path(mapper, connection, target):
+    history = sqlalchemy.orm.attributes.get_history(target, "parent_id")
+    if not history.has_changes():
+        return
+
+    table = Item.__table__
+    old_path = target.path
+    path = _get_path(connection, target.id, target.parent_id)
+    if old_path is not None and path is not None:
+        # Move the whole subtree
+        connection.execute(
+            table.update()\
+                .where(_get_path_range(table.c.path, old_path))\
+                .values(path=
+                    sqlalchemy.literal(path, sqlalchemy.String)+
+                    sqlalchemy.func.substr(
+                        table.c.path, len(old_path)+1,
+                        type_=sqlalchemy.String)))
+    else:
+        connection.execute(
+            table.update().where(table.c.id == target.id).values(path=path))
+    sqlalchemy.orm.attributes.set_committed_value(target, "path", path)
+
+@sqlalchemy.event.listens_for(Item, "after_update", propagate=True)
+def _update_visibility(mapper, connection, target):
+    # Must be run after _update_path, so that the path of target is up-to-date
+    if not any(
+            sqlalchemy.orm.attributes.get_history(target, x).has_changes()
+            for x in ["status", "parent_id"]):
+        return
+
+    table = Item.__table__
+    visible = _get_visibility(connection, target.status, target.parent_id)
+    if visible and target.path is not None:
+        # Visible unless an ancestor in the subtree (or the item itself) is
+        # unpublished
+        ancestor = table.alias()
+        end = sqlalchemy.func.substr(
+            ancestor.c.path, 1, sqlalchemy.func.length(ancestor.c.path)-1,
+            type_=sqlalchemy.String)+"0"
+        hidden = sqlalchemy.exists().where(sqlalchemy.and_(
+            _get_path_range(ancestor.c.path, target.path),
+            ancestor.c.status != "published",
+            table.c.path >= ancestor.c.path, table.c.path < end))
+        connection.execute(
+            table.update()\
+                .where(_get_subtree(target.id, target.path))\
+                .values(visible=~hidden))
+    else:
+        connection.execute(
+            table.update()\
+                .where(_get_subtree(target.id, target.path))\
+                .values(visible=visible))
+    if visible and target.path is None:
+        # No paths: hide the subtrees of the unpublished descendants
+        hidden = connection.execute(
+            sqlalchemy.select([table.c.id, table.c.path])\
+                .where(_get_subtree(target.id, target.path))\
+                .where(table.c.status != "published")).fetchall()
+        for id_, path in hidden:
+            connection.execute(
+                table.update()\
+                    .where(_get_subtree(id_, path))\
+                    .values(visible=False))
+    sqlalchemy.orm.attributes.set_committed_value(target, "visible", visible)
+
+def update_paths(connection):
+    """ Compute the materialized paths of all items, e.g. after upgrading a
+        database. Return the number of modified items.
+    """
+
+    table = Item.__table__
+    rows = connection.execute(
+        sqlalchemy.select([table.c.id, table.c.parent_id, table.c.path]))
+
+    children = collections.defaultdict(list)
+    old_paths = {}
+    for id_, parent_id, path in rows:
+        children[parent_id].append(id_)
+        old_paths[id_] = path
+
+    paths = {}
+    to_process = [(x, "/{}/".format(x)) for x in children[None]]
+    while to_process:
+        id_, path = to_process.pop()
+        paths[id_] = path
+        to_process.extend(
+            (x, "{}{}/".format(path, x)) for x in children[id_])
+
+    # Items which are not reachable from the top-level have no path
+    modified = [
+        {"id_": id_, "path_": paths.get(id_)}
+        for id_, path in old_paths.items() if paths.get(id_) != path]
+    if modified:
+        connection.execute(
+            table.update()\
+                .where(table.c.id == sqlalchemy.bindparam("id_"))\
+                .values(path=sqlalchemy.bindparam("path_")),
+            modified)
+
+    return len(modified)
+
+def update_visibility(connection):
+    """ Compute the visibility of all items, e.g. after upgrading a database.
+        Return the number of modified items.
+    """
+
+    table = Item.__table__
+    rows = connection.execute(
+        sqlalchemy.select([
+            table.c.id, table.c.parent_id, table.c.status, table.c.visible]))
+
+    children = collections.defaultdict(list)
+    statuses = {}
+    old_visibility = {}
+    for id_, parent_id, status, visible in rows:
+        children[parent_id].append(id_)
+        statuses[id_] = status
+        old_visibility[id_] = visible
+
+    visibility = {}
+    to_process = [(x, True) for x in children[None]]
+    while to_process:
+        id_, parent_visible = to_process.pop()
+        visible = parent_visible and statuses[id_] in [None, "published"]
+        visibility[id_] = visible
+        to_process.extend((x, visible) for x in children[id_])
+
+    # Items which are not reachable from the top-level have no visibility
+    modified = [
+        {"id_": id_, "visible_": visibility.get(id_)}
+        for id_, visible in old_visibility.items()
+        if visibility.get(id_) != visible]
+    if modified:
+        connection.execute(
+            table.update()\
+                .where(table.c.id == sqlalchemy.bindparam("id_"))\
+                .values(visible=sqlalchemy.bindparam("visible_")),
+            modified)
+
+    return len(modified)
@@ -31,6 +31,13 @@ class Media(Item):
     filename = sqlalchemy.Column(sqlalchemy.String)
     next_derivative = sqlalchemy.Column(sqlalchemy.Integer, default=1)
 
+    # Detected when the content is stored, None for legacy rows
+    mime_type = sqlalchemy.Column(sqlalchemy.String)
+    size = sqlalchemy.Column(sqlalchemy.BigInteger)
+    width = sqlalchemy.Column(sqlalchemy.Integer)
+    height = sqlalchemy.Column(sqlalchemy.Integer)
+    content_hash = sqlalchemy.Column(sqlalchemy.String(64))
+
     __mapper_args__ = { "polymorphic_identity": "media" }
 
     def __init__(self, *args, **kwargs):
@@ -39,4 +46,34 @@ class Media(Item):
         if not self.filename and content:
             self.filename = redmill.database.get_filesystem_path(self.name, content)
 
+    def set_content_info(self, info):
+        """ Store the MIME type, size, dimensions and hash of the content, as
+            returned by redmill.database.get_content_info.
+        """
+
+        for field in ["mime_type", "size", "width", "height", "content_hash"]:
+            setattr(self, field, info[field])
+
 Item.sub_types.append(Media)
+
+def update_content_info(connection, media_directory):
+    """ Compute the MIME type, size, dimensions and hash of the media stored
+        before they were recorded, e.g. after upgrading a database. Return the
+        number of modified media.
+    """
+
+    table = Media.__table__
+    rows = connection.execute(
+        sqlalchemy.select([table.c.id]).where(table.c.mime_type.is_(None)))
+
+    modified = 0
+    for id_, in rows.fetchall():
+        path = os.path.join(media_directory, "{}".format(id_))
+        if not os.path.isfile(path):
+            continue
+        info = redmill.database.get_content_info(path)
+        connection.execute(
+            table.update().where(table.c.id == id_).values(**info))
+        modified += 1
+
+    return modified
@@ -0,0 +1,60 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlalchemy
+
+from . import Base, Album
+
+class TreeVersion(Base):
+    """ Generation of the album hierarchy, incremented in the transactions
+        which create, modify or delete albums. Processes caching the
+        hierarchy compare it to the generation of their cache.
+    """
+
+    __tablename__ = "tree_version"
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    generation = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0)
+
+# Single row, created with the table
+sqlalchemy.event.listen(
+    TreeVersion.__table__, "after_create",
+    sqlalchemy.DDL("INSERT INTO tree_version (id, generation) VALUES (1, 0)"))
+
+def get_generation(connection):
+    """ Return the current generation of the album hierarchy.
+    """
+
+    table = TreeVersion.__table__
+    return connection.execute(
+        sqlalchemy.select([table.c.generation]).where(table.c.id == 1)
+    ).scalar() or 0
+
+def increment_generation(connection):
+    """ Mark the album hierarchy as modified, in the current transaction.
+    """
+
+    table = TreeVersion.__table__
+    connection.execute(
+        table.update()\
+            .where(table.c.id == 1)\
+            .values(generation=table.c.generation+1))
+
+@sqlalchemy.event.listens_for(Album, "after_insert", propagate=True)
+@sqlalchemy.event.listens_for(Album, "after_update", propagate=True)
+@sqlalchemy.event.listens_for(Album, "after_delete", propagate=True)
+def _increment_generation(mapper, connection, target):
+    increment_generation(connection)
@@ -0,0 +1,82 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import redmill.database
+
+from . import Base
+
+class UploadSession(Base):
+    """ Upload of a media content in chunks, possibly sent in any order.
+        The metadata are those of the media created when the upload is
+        finalized.
+    """
+
+    __tablename__ = "upload_session"
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    size = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    name = sqlalchemy.Column(sqlalchemy.Unicode, nullable=False)
+    author = sqlalchemy.Column(sqlalchemy.Unicode, nullable=False)
+    keywords = sqlalchemy.Column(redmill.database.JSON)
+    parent_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey("item.id"), nullable=False,
+        index=True)
+    created_at = sqlalchemy.Column(
+        sqlalchemy.DateTime, default=lambda: datetime.datetime.now())
+
+    chunks = sqlalchemy.orm.relationship(
+        "UploadChunk", order_by="asc(UploadChunk.offset)",
+        cascade="all, delete-orphan")
+
+    @property
+    def received(self):
+        """ Received ranges, as a sorted list of non-overlapping
+            (first byte, last byte).
+        """
+
+        ranges = []
+        for chunk in self.chunks:
+            start, end = chunk.offset, chunk.offset+chunk.length-1
+            if ranges and start <= ranges[-1][1]+1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    @property
+    def complete(self):
+        """ Test whether all the content has been received.
+        """
+
+        if self.size == 0:
+            return True
+        return self.received == [(0, self.size-1)]
+
+class UploadChunk(Base):
+    """ Chunk of content received by an upload session.
+    """
+
+    __tablename__ = "upload_chunk"
+
+    upload_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey("upload_session.id"),
+        primary_key=True)
+    offset = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    length = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
@@ -14,10 +14,24 @@
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
 import io
+import math
 
 import PIL.Image
 import redmill.magic
 
+# Names of the operations which can be used in a derivative
+Operations = ("rotate", "crop", "resize", "explicit", "transpose")
+
+# Rendering quality: minimum ratio between the size of the image before the
+# final resize and the target size when downscaling using the decoder (JPEG
+# draft mode) or integer-factor reduction. None disables these shortcuts.
+Quality = { "low": 1, "normal": 2, "high": None }
+
+# Modes supported by Image.reduce (not e.g. "1", "P" or "I;16")
+_reduce_modes = [
+    "L", "LA", "La", "RGB", "RGBA", "RGBa", "RGBX", "CMYK", "YCbCr", "LAB",
+    "HSV", "I", "F"]
+
 def rotate(image, degrees):
     """ Angle of rotation in degrees
     """
@@ -29,10 +43,8 @@ def crop(image, left, top, width, height, *args, **kwargs):
         specified either as a number of pixels or as "x%"
     """
 
-    left = int(_parse_value(left, lambda x:x*image.size[0]))
-    top = int(_parse_value(top, lambda x:x*image.size[1]))
-    width = int(_parse_value(width, lambda x:x*image.size[0]))
-    height = int(_parse_value(height, lambda x:x*image.size[1]))
+    left, top, width, height = _get_crop_box(
+        image.size, left, top, width, height)
 
     right = left+width
     bottom = top+height
@@ -46,19 +58,16 @@ def resize(image, width=None, height=None):
         is maintained.
     """
 
-    if width is None and height is None:
-        raise Exception("Width or height must be specified")
-    elif width is None:
-        height = _parse_value(height, lambda x:x*image.size[1])
-        width = image.size[0]*float(height)/float(image.size[1])
-    elif height is None:
-        width = _parse_value(width, lambda x:x*image.size[0])
-        height = image.size[1]*float(width)/float(image.size[0])
-    else:
-        width = _parse_value(width, lambda x:x*image.size[0])
-        height = _parse_value(height, lambda x:x*image.size[1])
+    return image.resize(
+        _get_resize_size(image.size, width, height), PIL.Image.BILINEAR)
 
-    return image.resize((int(width), int(height)), PIL.Image.BILINEAR)
+def transpose(image, method):
+    """ Flip the input image or rotate it by a multiple of 90 degrees. Method
+        is one of "flip_left_right", "flip_top_bottom", "rotate_90",
+        "rotate_180" or "rotate_270" (counter-clockwise rotations).
+    """
+
+    return image.transpose(_transpositions[method])
 
 def explicit(image, data):
     """
@@ -70,15 +79,277 @@ def explicit(image, data):
 
     return image
 
-def apply(operations, image):
-    """ Apply a list of operations to the given image.
+def apply(operations, image, quality="normal"):
+    """ Apply a list of operations to the given image. The operations are
+        first optimized by plan. Unless quality is "high", downscaling is
+        partly done by the decoder or by integer-factor reduction.
     """
 
     result = image
-    for operation, parameters in operations:
-        result = globals()[operation](result, **parameters)
+    operations = list(operations)
+    while operations:
+        # Operations following an unpredictable change of size are planned
+        # once the actual size is known.
+        planned, operations = _plan(operations, result.size)
+        result, planned = _reduce(result, planned, quality)
+        for operation, parameters in planned:
+            if operation not in Operations:
+                raise NotImplementedError(
+                    "Unknown operation: {}".format(operation))
+            result = globals()[operation](result, **parameters)
     return result
 
+def plan(operations, size):
+    """ Return a list of operations equivalent to the given ones but cheaper
+        to apply to an image of given size: crops are done before resizes,
+        consecutive crops, resizes and rotations are merged, rotations by
+        multiples of 90 degrees become transpositions and no-ops are removed.
+
+        Operations following an unpredictable change of size (arbitrary
+        rotation or explicit image) are returned unmodified.
+    """
+
+    planned, remaining = _plan(operations, size)
+    return planned+[tuple(x) for x in remaining]
+
+_transpositions = {
+    "flip_left_right": PIL.Image.FLIP_LEFT_RIGHT,
+    "flip_top_bottom": PIL.Image.FLIP_TOP_BOTTOM,
+    "rotate_90": PIL.Image.ROTATE_90,
+    "rotate_180": PIL.Image.ROTATE_180,
+    "rotate_270": PIL.Image.ROTATE_270,
+}
+
+class _Segment(object):
+    """ Sequence of crops, resizes and rotations by multiples of 90 degrees,
+        reduced to a crop of the source, followed by a resize and a
+        rotation.
+    """
+
+    def __init__(self, size):
+        self.size = tuple(size)
+        # Crop box (left, top, width, height) in source coordinates
+        self.box = (0., 0., float(size[0]), float(size[1]))
+        # Size before rotation
+        self.output = tuple(size)
+        # Counter-clockwise rotation, in degrees
+        self.rotation = 0
+
+    @property
+    def displayed_size(self):
+        if self.rotation in (90, 270):
+            return tuple(reversed(self.output))
+        else:
+            return self.output
+
+    def resize(self, width, height):
+        if self.rotation in (90, 270):
+            self.output = (height, width)
+        else:
+            self.output = (width, height)
+
+    def rotate(self, degrees):
+        self.rotation = (self.rotation+degrees)%360
+
+    def crop(self, left, top, width, height):
+        """ Merge a crop box, given in displayed coordinates, in the segment.
+            Return False if the box is not inside the displayed image.
+        """
+
+        output_width, output_height = self.output
+
+        # Box in output coordinates, before rotation
+        if self.rotation == 0:
+            box = (left, top, width, height)
+        elif self.rotation == 90:
+            box = (output_width-top-height, left, height, width)
+        elif self.rotation == 180:
+            box = (
+                output_width-left-width, output_height-top-height,
+                width, height)
+        else:
+            box = (top, output_height-left-width, height, width)
+
+        if (
+                width <= 0 or height <= 0 or box[0] < 0 or box[1] < 0 or
+                box[0]+box[2] > output_width or
+                box[1]+box[3] > output_height):
+            # Cropping outside the image pads it: this cannot be merged.
+            return False
+
+        x_scale = self.box[2]/output_width
+        y_scale = self.box[3]/output_height
+        self.box = (
+            self.box[0]+box[0]*x_scale, self.box[1]+box[1]*y_scale,
+            box[2]*x_scale, box[3]*y_scale)
+        self.output = (box[2], box[3])
+
+        return True
+
+    def get_operations(self):
+        operations = []
+
+        left, top, width, height = [int(round(x)) for x in self.box]
+        width = max(width, 1)
+        height = max(height, 1)
+        if (left, top, width, height) != (0, 0)+self.size:
+            operations.append((
+                "crop",
+                {"left": left, "top": top, "width": width, "height": height}))
+        if (width, height) != self.output:
+            operations.append((
+                "resize", {"width": self.output[0], "height": self.output[1]}))
+        if self.rotation != 0:
+            operations.append((
+                "transpose", {"method": "rotate_{}".format(self.rotation)}))
+
+        return operations
+
+def _plan(operations, size):
+    """ Plan the operations up to the first unpredictable change of size.
+        Return the planned operations and the remaining ones.
+    """
+
+    operations = list(operations)
+
+    planned = []
+    segment = _Segment(size)
+    for index, (operation, parameters) in enumerate(operations):
+        degrees = parameters.get("degrees") if operation == "rotate" else None
+        method = parameters.get("method") if operation == "transpose" else None
+
+        if operation == "explicit":
+            # Everything before is discarded, the size is unknown afterwards.
+            return [(operation, parameters)], operations[index+1:]
+        elif isinstance(degrees, (int, float)) and degrees%90 == 0:
+            segment.rotate(int(degrees%360))
+        elif method in ["rotate_90", "rotate_180", "rotate_270"]:
+            segment.rotate(int(method[len("rotate_"):]))
+        elif operation == "transpose":
+            planned.extend(segment.get_operations())
+            planned.append((operation, parameters))
+            segment = _Segment(segment.displayed_size)
+        elif operation == "crop":
+            box = _get_crop_box(segment.displayed_size, **parameters)
+            if not segment.crop(*box):
+                planned.extend(segment.get_operations())
+                planned.append((
+                    operation,
+                    dict(zip(["left", "top", "width", "height"], box))))
+                segment = _Segment(box[2:])
+        elif operation == "resize":
+            segment.resize(
+                *_get_resize_size(segment.displayed_size, **parameters))
+        else:
+            # Arbitrary rotation or unknown operation
+            planned.extend(segment.get_operations())
+            planned.append((operation, parameters))
+            return planned, operations[index+1:]
+
+    planned.extend(segment.get_operations())
+    return planned, []
+
+def _reduce(image, operations, quality):
+    """ If the planned operations start with a downscale (optional crop
+        followed by a resize), decode the image at a lower resolution (JPEG
+        only) and reduce it by an integer factor, keeping at least the
+        margin given by quality before the final resize.
+
+        Return the reduced image and the remaining operations.
+    """
+
+    margin = Quality[quality]
+    if margin is None:
+        return image, operations
+
+    index = 1 if operations and operations[0][0] == "crop" else 0
+    if len(operations) <= index or operations[index][0] != "resize":
+        return image, operations
+
+    size = image.size
+    if index == 1:
+        parameters = operations[0][1]
+        box = (
+            parameters["left"], parameters["top"],
+            parameters["width"], parameters["height"])
+    else:
+        box = (0, 0)+size
+    if (
+            box[0] < 0 or box[1] < 0 or
+            box[0]+box[2] > size[0] or box[1]+box[3] > size[1]):
+        return image, operations
+
+    target = (operations[index][1]["width"], operations[index][1]["height"])
+    def get_factor():
+        return min(
+            box[2]/float(target[0]), box[3]/float(target[1]))/margin
+
+    if get_factor() < 2:
+        return image, operations
+
+    # Let the decoder downscale (no-op if the image is not a JPEG or if it is
+    # already loaded). The decoded size is at least the requested size.
+    factor = get_factor()
+    image.draft(
+        image.mode,
+        (int(math.ceil(size[0]/factor)), int(math.ceil(size[1]/factor))))
+    if image.size != size:
+        x_scale = image.size[0]/float(size[0])
+        y_scale = image.size[1]/float(size[1])
+        box = (
+            int(round(box[0]*x_scale)), int(round(box[1]*y_scale)),
+            max(1, int(round(box[2]*x_scale))),
+            max(1, int(round(box[3]*y_scale))))
+        box = (
+            box[0], box[1],
+            min(box[2], image.size[0]-box[0]),
+            min(box[3], image.size[1]-box[1]))
+
+    # Box downscale of the (cropped) image
+    factor = int(get_factor())
+    if (
+            factor >= 2 and hasattr(image, "reduce")
+            and image.mode in _reduce_modes):
+        image = image.reduce(
+            factor, (box[0], box[1], box[0]+box[2], box[1]+box[3]))
+        box = (0, 0)+image.size
+
+    operations = operations[index:]
+    if box != (0, 0)+image.size:
+        operations.insert(0, (
+            "crop",
+            dict(zip(["left", "top", "width", "height"], box))))
+
+    return image, operations
+
+def _get_crop_box(size, left, top, width, height, *args, **kwargs):
+    """ Return the crop box (left, top, width, height) in pixels.
+    """
+
+    return (
+        int(_parse_value(left, lambda x:x*size[0])),
+        int(_parse_value(top, lambda x:x*size[1])),
+        int(_parse_value(width, lambda x:x*size[0])),
+        int(_parse_value(height, lambda x:x*size[1])))
+
+def _get_resize_size(size, width=None, height=None):
+    """ Return the target size (width, height) of a resize in pixels.
+    """
+
+    if width is None and height is None:
+        raise Exception("Width or height must be specified")
+    elif width is None:
+        height = _parse_value(height, lambda x:x*size[1])
+        width = size[0]*float(height)/float(size[1])
+    elif height is None:
+        width = _parse_value(width, lambda x:x*size[0])
+        height = size[1]*float(width)/float(size[0])
+    else:
+        width = _parse_value(width, lambda x:x*size[0])
+        height = _parse_value(height, lambda x:x*size[1])
+
+    return (int(width), int(height))
+
 def _parse_value(value, function=None):
     """ Transform a string parameter to a more usable value.
     """
@@ -0,0 +1,137 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import multiprocessing
+import os
+import threading
+
+import PIL.Image
+
+from . import processor
+
+class Busy(Exception):
+    """ Raised when the maximum number of rendering jobs is reached.
+    """
+
+class Timeout(Exception):
+    """ Raised when a rendering job takes too long.
+    """
+
+class LocalExecutor(object):
+    """ Render in the calling thread.
+    """
+
+    def render(self, filename, operations, quality="normal", blocking=False):
+        return render(filename, operations, quality)
+
+class ProcessExecutor(object):
+    """ Render in a pool of worker processes. Only the filename and the
+        operations are sent to the workers, which open the image themselves.
+
+        workers is the number of processes (default to the number of CPUs),
+        max_jobs is the maximum number of jobs submitted at the same time
+        (default to twice the number of workers) and timeout is the maximum
+        duration of a job in seconds (None for no limit).
+    """
+
+    def __init__(self, workers=None, max_jobs=None, timeout=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_jobs = max_jobs or 2*self.workers
+        self.timeout = timeout
+
+        self._jobs = threading.BoundedSemaphore(self.max_jobs)
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def render(self, filename, operations, quality="normal", blocking=False):
+        """ Render the derivative in a worker process. If blocking is False
+            and max_jobs jobs are already running, raise Busy.
+
+            A job which times out keeps its slot until it actually finishes,
+            so that it still counts in max_jobs.
+        """
+
+        jobs = self._jobs
+        if not jobs.acquire(blocking):
+            raise Busy()
+
+        def release(_):
+            jobs.release()
+
+        try:
+            result = self._get_pool().apply_async(
+                render, (filename, operations, quality),
+                callback=release, error_callback=release)
+        except:
+            jobs.release()
+            raise
+
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            raise Timeout()
+
+    def close(self):
+        """ Stop the worker processes.
+        """
+
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+            self._pool = None
+            self._pid = None
+            # The slots of the terminated jobs are never released
+            self._jobs = threading.BoundedSemaphore(self.max_jobs)
+
+    def _get_pool(self):
+        with self._lock:
+            # A pool cannot be used after a fork: create a new one in the
+            # child process.
+            if self._pid != os.getpid():
+                self._pool = multiprocessing.Pool(self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+def render(filename, operations, quality="normal"):
+    """ Apply the operations to the image stored in filename, return the
+        PNG-encoded result.
+    """
+
+    image = PIL.Image.open(filename)
+    result = processor.apply(operations, image, quality)
+
+    data = io.BytesIO()
+    result.save(data, format="PNG")
+    return data.getvalue()
+
+def prerender(
+        executor, cache, filename, media_id, derivatives, quality="normal"):
+    """ Render the derivatives of a media which are not already cached.
+        Derivatives are given as a list of (id, operations).
+    """
+
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return
+
+    for id_, operations in derivatives:
+        if not cache.contains(media_id, id_, operations, mtime, quality):
+            data = executor.render(
+                filename, operations, quality, blocking=True)
+            cache.put(media_id, id_, operations, mtime, data, quality)
@@ -0,0 +1,97 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+class LocalQueue(object):
+    """ Run the tasks immediately, in the calling thread.
+    """
+
+    depth = 0
+
+    def submit(self, function, *args, **kwargs):
+        _run_task(function, args, kwargs)
+
+    def join(self):
+        pass
+
+class ThreadQueue(object):
+    """ Run the tasks in background threads. The threads are started when
+        the first task is submitted.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+        self._queue = queue.Queue()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self):
+        """ Number of pending or running tasks.
+        """
+
+        return self._queue.unfinished_tasks
+
+    def submit(self, function, *args, **kwargs):
+        self._start()
+        self._queue.put((function, args, kwargs))
+
+    def join(self):
+        """ Wait until all tasks are done.
+        """
+
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            # Threads do not survive a fork: restart them in the child process.
+            if self._pid == os.getpid():
+                return
+
+            self._threads = [
+                threading.Thread(target=self._run) for _ in range(self.workers)]
+            for thread in self._threads:
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            function, args, kwargs = self._queue.get()
+            try:
+                _run_task(function, args, kwargs)
+            finally:
+                self._queue.task_done()
+
+def _run_task(function, args, kwargs):
+    """ Run a task, logging its errors: failed tasks must not affect the
+        caller.
+    """
+
+    try:
+        function(*args, **kwargs)
+    except Exception:
+        logging.getLogger(__name__).exception("Task failed")
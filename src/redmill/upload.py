@@ -0,0 +1,140 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import tempfile
+
+from . import database, magic
+
+# Atomically replace the destination, if it exists
+_replace = getattr(os, "replace", os.rename)
+
+class Upload(object):
+    """ Content written to a temporary file of directory, and moved to its
+        final location once complete. The size, hash and MIME type of the
+        content are computed while it is written.
+
+        If path is given, it is an existing and complete temporary file of
+        directory (e.g. spooled by the form parser), which is read to compute
+        its information instead of being copied.
+    """
+
+    # Size of the beginning of the content used to guess its type
+    head_size = 65536
+
+    def __init__(self, directory, chunk_size=65536, path=None):
+        self.chunk_size = chunk_size
+
+        self._head = b""
+        self._size = 0
+        self._hash = hashlib.sha256()
+        self._mime_type = None
+
+        if path is None:
+            fd, self.path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+            self._file = os.fdopen(fd, "wb")
+        else:
+            self.path = path
+            self._file = open(path, "rb")
+            while True:
+                data = self._file.read(chunk_size)
+                if not data:
+                    break
+                self._update(data)
+            self.close()
+
+    def write(self, data):
+        """ Append data to the content.
+        """
+
+        self._file.write(data)
+        self._update(data)
+
+    def copy(self, stream):
+        """ Append the content of a file-like object, read in chunks.
+        """
+
+        while True:
+            data = stream.read(self.chunk_size)
+            if not data:
+                break
+            self.write(data)
+
+    def close(self):
+        """ Finish writing the content.
+        """
+
+        if not self._file.closed:
+            self._file.close()
+            self._mime_type = magic.buffer(self._head).decode("utf-8")
+            self._head = b""
+
+    @property
+    def info(self):
+        """ MIME type, size, dimensions and hash of the content, in the same
+            format as redmill.database.get_content_info.
+        """
+
+        self.close()
+        width, height = database.get_image_size(self.path)
+        return {
+            "mime_type": self._mime_type, "size": self._size,
+            "width": width, "height": height,
+            "content_hash": self._hash.hexdigest()
+        }
+
+    def commit(self, path):
+        """ Move the content to path, replacing the existing file.
+        """
+
+        self.close()
+        _replace(self.path, path)
+
+    def abort(self):
+        """ Remove the content.
+        """
+
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _update(self, data):
+        """ Update the size, hash and head with the next data of the content.
+        """
+
+        self._size += len(data)
+        self._hash.update(data)
+        if len(self._head) < self.head_size:
+            self._head += data[:self.head_size-len(self._head)]
+
+def write_range(path, offset, stream, length, chunk_size=65536):
+    """ Write at most length bytes of a file-like object, read in chunks, at
+        the given offset of an existing file. Return the number of bytes
+        written.
+    """
+
+    written = 0
+    with open(path, "r+b") as fd:
+        fd.seek(offset)
+        while written < length:
+            data = stream.read(min(chunk_size, length-written))
+            if not data:
+                break
+            fd.write(data)
+            written += len(data)
+    return written
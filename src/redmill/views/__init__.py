@@ -1,7 +1,13 @@
 from .base import (
-    authenticate, get_item, jsonify, request_wants_json, get_children_filter, get_tree)
+    authenticate, get_item, get_items, get_ids, jsonify, request_wants_json, get_children_filter, get_tree,
+    get_tree_snapshot, invalidate_tree,
+    get_cache, prerender, get_request_content, upload_content, Request,
+    get_content_validators, get_validation_headers, is_not_modified, send_file)
 from . import album
 from . import derivative
+from . import importer
 from . import media
 from . import media_content
+from . import render_queue
 from . import token
+from . import upload_session
@@ -13,52 +13,68 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import datetime
 import json
 import os
+import uuid
 
 import flask
 import flask.json
+import sqlalchemy
+import sqlalchemy.orm
 
-from .. import database, models
+from .. import database, models, serializer
 from . import (
-    authenticate, get_item, jsonify, request_wants_json, get_children_filter, get_tree)
+    authenticate, get_cache, get_item, jsonify, request_wants_json,
+    get_children_filter, get_tree)
 
-def get_album(id_):
+def get_album(id_, rows=False):
     """ Return the requested album (or the top-level dummy album if id_ is None)
         after filtering its children and paginating.
 
+        If rows is True, the children are not loaded as objects but as
+        (type, id, rank) rows in a "child_rows" member, which is enough to
+        serialize the album to JSON.
+
         Since we are filtering the children, the album must not be in the
         session and the parents are hence returned as a separate value.
 
-        Pagination links are added as a "links" member.
+        Pagination links are added as a "links" member. Pages are either
+        numbered (page parameter) or, if the cursor parameter is present
+        (empty for the first page), given by an opaque cursor which is not
+        affected by concurrent modifications of the album.
     """
 
     session = database.Session()
 
     if id_ is None:
-        album = models.Album.get_toplevel()
+        album = models.Album.get_toplevel(False)
         parents = []
     else:
-        album = get_item(session, models.Album, id_)
+        album = get_item(
+            session, models.Album, id_,
+            sqlalchemy.orm.noload(models.Album.children))
         parents = album.parents
         # Avoid modifying the session: remove the album from the session before
-        # filtering children
+        # setting its children
         session.expunge(album)
 
-    children_filter = get_children_filter()
-    album.children = [
-        x for x in album.children if x.status in children_filter]
-
-    try:
-        page = int(flask.request.args.get("page", 1))
-    except ValueError as e:
-        flask.abort(400)
-    # Switch to 0-based indices
-    page -= 1
+    if rows:
+        children = session.query(
+            models.Item.type, models.Item.id, models.Item.rank)
+        if id_ is None:
+            children = children.filter(models.Item.type == "album")
+    elif id_ is None:
+        # Only albums are allowed at the top-level
+        children = session.query(models.Album)
+    else:
+        children = session.query(sqlalchemy.orm.with_polymorphic(
+            models.Item, models.Item.sub_types))
 
-    if page < 0:
-        flask.abort(400)
+    children = children.filter(
+        models.Item.parent_id == id_,
+        models.Item.status.in_(get_children_filter()))
 
     try:
         per_page = int(flask.request.args.get("per_page", 30))
@@ -67,36 +83,21 @@ def get_album(id_):
     if per_page <= 0 or per_page > 100:
         flask.abort(400)
 
-    last_page = int(len(album.children)/per_page)
-
-    # Last page is 0-based
-    if page > last_page:
-        flask.abort(400)
-
-    begin = page*per_page
-    end = begin+per_page
-
-    album.children = album.children[begin:end]
-
-    # Values in links are 1-based
-    links = {}
-    if page > 1:
-        links["previous"] = flask.url_for(
-            "album.get_roots", page=(page+1)-1, per_page=per_page)
-        links["first"] = flask.url_for("album.get_roots", page=1, per_page=per_page)
-    if page < last_page:
-        links["next"] = flask.url_for(
-            "album.get_roots", page=(page+1)+1, per_page=per_page)
-        links["last"] = flask.url_for(
-            "album.get_roots", page=last_page+1, per_page=per_page)
+    if "cursor" in flask.request.args:
+        children, album.links = _get_cursor_page(children, per_page)
+    else:
+        children, album.links = _get_numbered_page(children, per_page)
 
-    album.links = links
+    if rows:
+        album.child_rows = children
+    else:
+        album.children = children
 
     return album, parents
 
 def as_html(album, parents, children_filter, creation=False):
     parameters = {
-        "album": album, "parents": [models.Album.get_toplevel()] + parents,
+        "album": album, "parents": [models.Album.get_toplevel(False)] + parents,
         "children_filter": children_filter, "creation": creation,
         "tree": get_tree(album.id)
     }
@@ -108,22 +109,29 @@ def as_html(album, parents, children_filter, creation=False):
     return flask.render_template("album.html", **parameters)
 
 def get(id_):
-    album, parents = get_album(id_)
-    if request_wants_json():
-        return jsonify(album)
+    wants_json = request_wants_json()
+    embed, fields = _get_embed_parameters()
+    album, parents = get_album(id_, wants_json and not embed)
+    if wants_json:
+        if embed:
+            data = flask.current_app.json_encoder().default(album)
+            data["children"] = _get_embedded_children(album.children, fields)
+        else:
+            data = album
+        return jsonify(data, headers=_get_link_header(album.links))
     else:
         return as_html(album, parents, get_children_filter())
 
 def get_roots():
-    album, parents = get_album(None)
-    if request_wants_json():
-        urls = [
-            flask.url_for("album.get", id_=child.id)
-            for child in album.children
-        ]
-        links = ", ".join(
-            "<{}>; rel=\"{}\"".format(link, type_) for type_, link in album.links.items())
-        return jsonify(urls, headers={"Link": links})
+    wants_json = request_wants_json()
+    embed, fields = _get_embed_parameters()
+    album, parents = get_album(None, wants_json and not embed)
+    if wants_json:
+        if embed:
+            data = _get_embedded_children(album.children, fields)
+        else:
+            data = serializer.get_item_urls(album.child_rows)
+        return jsonify(data, headers=_get_link_header(album.links))
     else:
         return as_html(album, parents, get_children_filter())
 
@@ -168,19 +176,35 @@ def delete(id_):
     if value is None:
         flask.abort(404)
     else:
-        to_delete = []
-        to_process = [value]
-        while to_process:
-            album = to_process.pop(0)
-            for child in album.children:
-                to_delete.insert(0, child)
-                if child.type == "album":
-                    to_process.insert(0, child)
-        for item in to_delete:
-            session.delete(item)
-
-        session.delete(value)
-        session.commit()
+        try:
+            media, uploads = value.delete_tree()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            flask.abort(500, e)
+
+        # The ids may be reused as soon as the rows are gone: move the files
+        # and the cached derivatives out of the way now, and remove them in
+        # the background.
+        directory = flask.current_app.config["media_directory"]
+        filenames = (
+            ["{}".format(x) for x in media]+
+            [".session-{}".format(x) for x in uploads])
+        trash = []
+        for filename in filenames:
+            destination = os.path.join(
+                directory, ".deleted-{}".format(uuid.uuid4().hex))
+            try:
+                os.rename(os.path.join(directory, filename), destination)
+            except OSError:
+                # No file
+                continue
+            trash.append(destination)
+        cache = get_cache()
+        detached = [cache.detach(x) for x in media]
+        flask.current_app.config["render_queue"].submit(
+            _remove_files, trash, cache, [x for x in detached if x is not None])
+
         return "", 204 # No content
 
 @authenticate()
@@ -193,38 +217,294 @@ def create(parent_id=None):
             flask.abort(404)
         parents = parent.parents+[parent]
     else:
-        parent = models.Album.get_toplevel()
         parents = []
 
     album = models.Album(
-        id=None, parent_id=parent_id, name="", rank=len(parent.children))
+        id=None, parent_id=parent_id, name="",
+        rank=session.query(models.Item).filter_by(parent_id=parent_id).count())
     return as_html(album, parents, ["published"], True)
 
 @authenticate()
 def order_children(id_):
-    children_ids = json.loads(flask.request.data.decode("utf-8"))
-    if not isinstance(children_ids, (list, tuple)):
+    """ Set the order of the children of an album. The request contains
+        either the list of all the children ids, or a partial move as
+        {"id": moved_id, "before": other_id}, other_id being None to move the
+        child at the end.
+
+        The ranks are renumbered as 0..n-1 and only the modified ones are
+        written: since new items are placed after their siblings, a move
+        usually only updates the children between its old and new positions.
+    """
+
+    try:
+        data = json.loads(flask.request.data.decode("utf-8"))
+    except:
         flask.abort(400)
 
     session = database.Session()
 
-    if id_ is None:
-        album = models.Album.get_toplevel()
-    else:
-        album = get_item(session, models.Album, id_)
+    if id_ is not None:
+        get_item(
+            session, models.Album, id_,
+            sqlalchemy.orm.noload(models.Album.children))
+
+    item = models.Item.__table__
+    children = session.execute(
+        sqlalchemy.select([item.c.id, item.c.rank])\
+            .where(item.c.parent_id == id_)\
+            .order_by(item.c.rank, item.c.id)).fetchall()
+    ranks = dict((x, y) for x, y in children)
+    order = [x for x, _ in children]
+
+    if isinstance(data, (list, tuple)):
+        if not all(_is_id(x) for x in data):
+            flask.abort(400)
+        if set(order) != set(data) or len(order) != len(data):
+            flask.abort(400)
+        order = data
+    elif isinstance(data, dict):
+        if not _is_id(data.get("id")) or data["id"] not in ranks:
+            flask.abort(400)
+        before = data.get("before")
+        if before is not None and (
+                not _is_id(before) or before not in ranks
+                or before == data["id"]):
+            flask.abort(400)
 
-    album_children = [x.id for x in album.children]
-    if set(album_children) != set(children_ids):
+        order.remove(data["id"])
+        index = order.index(before) if before is not None else len(order)
+        order.insert(index, data["id"])
+    else:
         flask.abort(400)
 
-    for index, child_id in enumerate(children_ids):
-        item = session.query(models.Item).get(child_id)
-        item.rank = index
-
+    # Only update the children whose rank changed
+    modified = [
+        {"id_": child_id, "rank_": index}
+        for index, child_id in enumerate(order) if ranks[child_id] != index]
+    if modified:
+        session.execute(
+            item.update()\
+                .where(item.c.id == sqlalchemy.bindparam("id_"))\
+                .values(rank=sqlalchemy.bindparam("rank_")),
+            modified)
+        # The order of the albums in the tree may have changed
+        models.tree_version.increment_generation(session.connection())
     session.commit()
 
     return ("", 200)
 
+def _remove_files(filenames, cache, cache_directories):
+    """ Remove the files and the detached cached derivatives (cf. Cache.detach)
+        of deleted media.
+    """
+
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    for directory in cache_directories:
+        cache.remove_detached(directory)
+
+def _get_embed_parameters():
+    """ Return whether the children must be embedded in the response (embed
+        parameter) and the set of their requested fields (fields parameter,
+        comma-separated, None if absent).
+    """
+
+    embed = flask.request.args.get("embed", "")
+    if embed not in ["", "children"]:
+        flask.abort(400)
+
+    fields = flask.request.args.get("fields")
+    if fields is not None:
+        fields = set(x.strip() for x in fields.split(",") if x.strip())
+
+    return (embed == "children"), fields
+
+def _get_embedded_children(children, fields):
+    """ Return the JSON representation of the children, restricted to the
+        given fields (None for all fields). In addition to the fields of the
+        JSON encoder, each child has a "url" and each media has "derivatives"
+        URLs. The children of albums and the derivatives of media are fetched
+        with one query each, regardless of the number of children.
+    """
+
+    session = database.Session()
+
+    def wanted(field):
+        return fields is None or field in fields
+
+    albums = [x.id for x in children if isinstance(x, models.Album)]
+    media = [x.id for x in children if isinstance(x, models.Media)]
+
+    grandchildren = {}
+    if albums and wanted("children"):
+        rows = session\
+            .query(
+                models.Item.parent_id, models.Item.type, models.Item.id)\
+            .filter(
+                models.Item.parent_id.in_(albums),
+                models.Item.status.in_(get_children_filter()))\
+            .order_by(models.Item.parent_id, models.Item.rank, models.Item.id)
+        for parent_id, type_, id_ in rows:
+            grandchildren.setdefault(parent_id, []).append((type_, id_))
+
+    derivatives = {}
+    if media and wanted("derivatives"):
+        template = serializer.get_url_template(
+            "derivative.get", "media_id", "id_")
+        rows = session\
+            .query(models.Derivative.media_id, models.Derivative.id)\
+            .filter(models.Derivative.media_id.in_(media))\
+            .order_by(models.Derivative.media_id, models.Derivative.id)
+        for media_id, id_ in rows:
+            derivatives.setdefault(media_id, []).append(
+                template.format(media_id=media_id, id_=id_))
+
+    encoder = flask.current_app.json_encoder()
+    urls = serializer.get_item_urls([(x.type, x.id) for x in children])
+    result = []
+    for child, url in zip(children, urls):
+        if isinstance(child, models.Album):
+            # Avoid a query per album in the encoder
+            child.child_rows = grandchildren.get(child.id, [])
+        value = encoder.default(child)
+        value["url"] = url
+        if isinstance(child, models.Media):
+            value["derivatives"] = derivatives.get(child.id, [])
+
+        if fields is not None:
+            # Always keep what identifies the child
+            value = {
+                key: item for key, item in value.items()
+                if key in fields or key in ["id", "type", "url"]}
+        result.append(value)
+
+    return result
+
+def _get_numbered_page(children, per_page):
+    """ Return the children in the requested page and the pagination links.
+    """
+
+    try:
+        page = int(flask.request.args.get("page", 1))
+    except ValueError as e:
+        flask.abort(400)
+    # Switch to 0-based indices
+    page -= 1
+
+    if page < 0:
+        flask.abort(400)
+
+    # Last page is 0-based, an empty album has one empty page
+    last_page = max(0, (children.count()-1)//per_page)
+
+    if page > last_page:
+        flask.abort(400)
+
+    children = children\
+        .order_by(models.Item.rank, models.Item.id)\
+        .limit(per_page).offset(page*per_page)\
+        .all()
+
+    # Values in links are 1-based
+    links = {}
+    if page > 0:
+        links["previous"] = _get_page_url(page=(page+1)-1, per_page=per_page)
+        links["first"] = _get_page_url(page=1, per_page=per_page)
+    if page < last_page:
+        links["next"] = _get_page_url(page=(page+1)+1, per_page=per_page)
+        links["last"] = _get_page_url(page=last_page+1, per_page=per_page)
+
+    return children, links
+
+def _get_cursor_page(children, per_page):
+    """ Return the children following (or preceding) the cursor and the
+        pagination links. The cursor encodes the direction and the (rank, id)
+        key of the last item of the previous page.
+    """
+
+    cursor = flask.request.args["cursor"]
+    if cursor:
+        try:
+            direction, rank, id_ = json.loads(
+                base64.urlsafe_b64decode(cursor.encode()).decode())
+        except Exception:
+            flask.abort(400)
+        if direction not in ["next", "previous"] or not (
+                _is_id(rank) and _is_id(id_)):
+            flask.abort(400)
+    else:
+        direction, rank, id_ = "next", None, None
+
+    if direction == "next":
+        order = [models.Item.rank, models.Item.id]
+        if id_ is not None:
+            children = children.filter(sqlalchemy.or_(
+                models.Item.rank > rank,
+                sqlalchemy.and_(models.Item.rank == rank, models.Item.id > id_)))
+    else:
+        order = [models.Item.rank.desc(), models.Item.id.desc()]
+        children = children.filter(sqlalchemy.or_(
+            models.Item.rank < rank,
+            sqlalchemy.and_(models.Item.rank == rank, models.Item.id < id_)))
+
+    # Fetch one more item to know if there is a following page
+    children = children.order_by(*order).limit(per_page+1).all()
+    more = len(children) > per_page
+    children = children[:per_page]
+    if direction == "previous":
+        children.reverse()
+
+    def get_cursor(direction, item):
+        data = json.dumps([direction, item.rank, item.id]).encode()
+        return base64.urlsafe_b64encode(data).decode()
+
+    links = {}
+    if direction == "next":
+        has_previous, has_next = (id_ is not None), more
+    else:
+        has_previous, has_next = more, True
+    if has_previous:
+        links["first"] = _get_page_url(cursor="", per_page=per_page)
+        if children:
+            links["previous"] = _get_page_url(
+                cursor=get_cursor("previous", children[0]), per_page=per_page)
+    if has_next and children:
+        links["next"] = _get_page_url(
+            cursor=get_cursor("next", children[-1]), per_page=per_page)
+
+    return children, links
+
+def _is_id(value):
+    """ Test whether a decoded JSON value is an integer (e.g. an id or a rank).
+    """
+
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _get_page_url(**arguments):
+    """ Return the URL of the current view with the given pagination
+        arguments, keeping the other parameters of the request.
+    """
+
+    for name, value in flask.request.args.items():
+        if name not in ["page", "cursor"]:
+            arguments.setdefault(name, value)
+    arguments.update(flask.request.view_args)
+    return flask.url_for(flask.request.endpoint, **arguments)
+
+def _get_link_header(links):
+    """ Return the Link header of the pagination links, if any.
+    """
+
+    if not links:
+        return {}
+    return {
+        "Link": ", ".join(
+            "<{}>; rel=\"{}\"".format(link, type_)
+            for type_, link in links.items())}
+
 def _update(id_):
     fields = ["name", "parent_id", "status"]
 
@@ -13,23 +13,83 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
+import collections
 import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
 
 import flask
 import itsdangerous
+import werkzeug.http
+import werkzeug.wsgi
 
+import redmill.cache
+import redmill.database
 import redmill.models
+import redmill.render
+import redmill.serializer
+import redmill.upload
 
-def get_item(session, model, id_):
-    item = session.query(model).get(id_)
+def get_item(session, model, id_, *options):
+    """ Return the item, or abort if it does not exist or if it is not visible.
+        Options are passed to the query (e.g. loader options).
+    """
+
+    item = session.query(model).options(*options).get(id_)
 
     if item is None:
         flask.abort(404)
-    elif not all([x.status == "published" for x in item.parents+[item]]) and not is_authenticated():
+    elif not item.is_visible() and not is_authenticated():
         flask.abort(404)
 
     return item
 
+def get_items(session, model, ids, *criteria):
+    """ Return the existing and visible items among the given ids, in the same
+        order, using a single query. Additional criteria are passed to the
+        query filter.
+
+        Items whose visibility is unknown (cf. update_visibility) fall back
+        to the walk of their ancestors.
+    """
+
+    items = session.query(model)\
+        .filter(model.id.in_(set(ids)), *criteria)\
+        .all()
+    if not is_authenticated():
+        items = [x for x in items if x.is_visible()]
+
+    items = {x.id: x for x in items}
+    result = []
+    for id_ in ids:
+        item = items.pop(id_, None)
+        if item is not None:
+            result.append(item)
+    return result
+
+def get_ids():
+    """ Return the comma-separated list of integers of the "ids" request
+        parameter, or abort if it is missing, invalid or longer than the
+        max_batch_size setting.
+    """
+
+    try:
+        ids = [
+            int(x) for x in flask.request.args["ids"].split(",") if x.strip()]
+    except (KeyError, ValueError):
+        flask.abort(400)
+
+    if not ids or len(ids) > flask.current_app.config["max_batch_size"]:
+        flask.abort(400)
+
+    return ids
+
 def token_authenticator(request):
     if request.authorization is None:
         return False
@@ -81,10 +141,284 @@ def request_wants_json():
         accept_mimetypes[best] > accept_mimetypes["text/html"])
 
 def jsonify(data, *args, **kwargs):
-    json_data = flask.json.dumps(data)
+    json_data = redmill.serializer.dumps(data)
     return flask.Response(
         json_data, *args, mimetype="application/json", **kwargs)
 
+def get_cache():
+    """ Return the cache of rendered derivatives. The cache is shared by the
+        requests of the process, so that its size is tracked in memory.
+    """
+
+    config = flask.current_app.config
+    directory = config["cache_directory"]
+    if directory is None:
+        directory = os.path.join(config["media_directory"], "cache")
+
+    key = (directory, config["cache_size"])
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = redmill.cache.Cache(directory, config["cache_size"])
+        return _caches[key]
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def prerender(media_id, derivatives):
+    """ Render the derivatives of a media in the background. Derivatives are
+        given as a list of (id, operations).
+    """
+
+    config = flask.current_app.config
+    filename = os.path.join(config["media_directory"], "{}".format(media_id))
+    config["render_queue"].submit(
+        redmill.render.prerender, config["render_executor"], get_cache(),
+        filename, media_id, derivatives, config["render_quality"])
+
+def get_request_content():
+    """ Return a stream over the content uploaded in a request: the "content"
+        file of a multipart form, or the raw body if it is an image, a video
+        or an audio file, or if the request has a "Content-Transfer-Encoding:
+        binary" header. Return None for the other (legacy) requests, where
+        the content is base64-encoded.
+    """
+
+    mimetype = flask.request.mimetype
+    if mimetype == "multipart/form-data":
+        content = flask.request.files.get("content")
+        if content is None:
+            flask.abort(400)
+        return content.stream
+    elif (
+            mimetype.split("/")[0] in ["image", "video", "audio"]
+            or flask.request.headers.get(
+                "Content-Transfer-Encoding", "").lower() == "binary"):
+        return flask.request.stream
+    else:
+        return None
+
+def upload_content(content):
+    """ Write the content (either bytes or a file-like object read in chunks)
+        to a temporary file of the media directory and return the
+        corresponding redmill.upload.Upload. Files spooled to the media
+        directory by the form parser (cf. Request) are used without copy.
+    """
+
+    directory = flask.current_app.config["media_directory"]
+    if getattr(content, "name", None) in flask.request.spooled_files:
+        content.close()
+        return redmill.upload.Upload(directory, path=content.name)
+
+    upload = redmill.upload.Upload(directory)
+    try:
+        if isinstance(content, bytes):
+            upload.write(content)
+        else:
+            upload.copy(content)
+        upload.close()
+    except:
+        upload.abort()
+        raise
+    return upload
+
+class Request(flask.Request):
+    """ Request whose uploaded files are spooled to temporary files of the
+        media directory, so that they can be moved in place instead of being
+        written again. The remaining temporary files are removed when the
+        request is closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        flask.Request.__init__(self, *args, **kwargs)
+        self.spooled_files = []
+
+    def close(self):
+        flask.Request.close(self)
+        for path in self.spooled_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.spooled_files = []
+
+    def _get_file_stream(
+            self, total_content_length, content_type, filename=None,
+            content_length=None):
+        directory = flask.current_app.config["media_directory"]
+        if directory is None:
+            return flask.Request._get_file_stream(
+                self, total_content_length, content_type, filename,
+                content_length)
+
+        stream = tempfile.NamedTemporaryFile(
+            "w+b", dir=directory, prefix=".upload-", delete=False)
+        self.spooled_files.append(stream.name)
+        return stream
+
+def get_content_validators(media, *values):
+    """ Return a strong ETag and the modification time (as a timestamp) of the
+        content of a media. Additional values (e.g. the operations of a
+        derivative) are included in the ETag.
+    """
+
+    modified_at = media.modified_at or media.created_at
+    etag = hashlib.sha1(json.dumps(
+            [media.id, modified_at.isoformat()]+list(values),
+            sort_keys=True).encode("utf-8"))
+    return etag.hexdigest(), int(time.mktime(modified_at.timetuple()))
+
+def get_validation_headers(etag, last_modified):
+    """ Return the caching headers of a content.
+    """
+
+    headers = {
+        "ETag": werkzeug.http.quote_etag(etag),
+        "Last-Modified": werkzeug.http.http_date(last_modified),
+    }
+    cache_control = flask.current_app.config["cache_control"]
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    return headers
+
+def is_not_modified(etag, last_modified):
+    """ Test whether the conditional headers of the request match the
+        validators of a content.
+    """
+
+    request = flask.request
+    if request.if_none_match:
+        # If-None-Match has precedence over If-Modified-Since
+        return request.if_none_match.contains(etag)
+    elif request.if_modified_since is not None:
+        return (
+            last_modified <=
+            calendar.timegm(request.if_modified_since.utctimetuple()))
+    else:
+        return False
+
+def send_file(filename, mimetype, headers, etag=None, last_modified=None):
+    """ Return a response with the content of a file, without reading it in
+        memory. Byte ranges are supported: if the request has a Range header
+        (and its If-Range header, if any, matches the validators), only the
+        requested parts are sent.
+
+        If the sendfile setting is "X-Sendfile" or "X-Accel-Redirect", the
+        file is sent by the fronting server.
+    """
+
+    config = flask.current_app.config
+
+    headers = dict(headers)
+    headers["Content-Type"] = mimetype
+
+    if config["sendfile"] == "X-Sendfile":
+        headers["X-Sendfile"] = filename
+        return flask.Response(b"", 200, headers)
+    elif config["sendfile"] == "X-Accel-Redirect":
+        path = os.path.relpath(filename, config["media_directory"])
+        headers["X-Accel-Redirect"] = "{}/{}".format(
+            config["sendfile_prefix"].rstrip("/"), path)
+        return flask.Response(b"", 200, headers)
+
+    headers["Accept-Ranges"] = "bytes"
+
+    fd = open(filename, "rb")
+    size = os.fstat(fd.fileno()).st_size
+
+    ranges = _get_ranges(size, etag, last_modified)
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        return flask.Response(
+            werkzeug.wsgi.wrap_file(flask.request.environ, fd), 200, headers,
+            direct_passthrough=True)
+    elif not ranges:
+        fd.close()
+        headers["Content-Range"] = "bytes */{}".format(size)
+        del headers["Content-Type"]
+        return flask.Response(b"", 416, headers)
+    elif len(ranges) == 1:
+        begin, end = ranges[0]
+        headers["Content-Range"] = "bytes {}-{}/{}".format(begin, end-1, size)
+        headers["Content-Length"] = str(end-begin)
+        return flask.Response(
+            _read_ranges(fd, ranges), 206, headers, direct_passthrough=True)
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [
+            (
+                "--{}\r\nContent-Type: {}\r\n"
+                "Content-Range: bytes {}-{}/{}\r\n\r\n".format(
+                    boundary, mimetype, begin, end-1, size).encode("utf-8"),
+                (begin, end))
+            for begin, end in ranges]
+        footer = "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+
+        headers["Content-Type"] = "multipart/byteranges; boundary={}".format(
+            boundary)
+        headers["Content-Length"] = str(
+            sum(len(header)+(end-begin) for header, (begin, end) in parts)+
+            2*(len(parts)-1)+len(footer))
+        return flask.Response(
+            _read_ranges(fd, ranges, parts, footer), 206, headers,
+            direct_passthrough=True)
+
+def _get_ranges(size, etag, last_modified):
+    """ Return the byte ranges requested for a content of given size, as a
+        list of (begin, end), end being excluded. Return None if the whole
+        content must be sent, and an empty list if no range is satisfiable.
+    """
+
+    request = flask.request
+    if request.range is None or request.range.units != "bytes":
+        return None
+
+    if_range = request.headers.get("If-Range")
+    if if_range:
+        if_range = request.if_range
+        if if_range.etag is not None and if_range.etag != etag:
+            return None
+        elif if_range.date is not None and (
+                last_modified is None or
+                calendar.timegm(if_range.date.utctimetuple()) != last_modified):
+            return None
+
+    ranges = []
+    for begin, end in request.range.ranges:
+        if begin < 0:
+            begin, end = max(0, size+begin), size
+        else:
+            end = size if end is None else min(end, size)
+        if begin < end:
+            ranges.append((begin, end))
+
+    return ranges
+
+def _read_ranges(fd, ranges, headers=None, footer=None, chunk_size=65536):
+    """ Yield the content of the byte ranges of a file, preceded by their
+        headers and followed by a footer if given.
+    """
+
+    try:
+        for index, (begin, end) in enumerate(ranges):
+            if headers:
+                if index != 0:
+                    yield b"\r\n"
+                yield headers[index][0]
+
+            fd.seek(begin)
+            remaining = end-begin
+            while remaining > 0:
+                data = fd.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+        if footer:
+            yield footer
+    finally:
+        fd.close()
+
 def get_children_filter():
     children_filter = flask.request.args.get("children")
     if not children_filter:
@@ -94,31 +428,115 @@ def get_children_filter():
 
     return children_filter
 
+# Snapshot of the album hierarchy (parent id -> [(id, name)]) and rendered
+# trees, valid for a given generation of the hierarchy (cf.
+# redmill.models.tree_version)
+_tree = {"snapshot": None, "html": collections.OrderedDict()}
+_tree_lock = threading.Lock()
+# Number of rendered trees (i.e. of limits) kept in memory
+_tree_html_size = 64
+
+def invalidate_tree():
+    """ Discard the album tree cached by this process, e.g. when switching
+        to another database. Modifications of the albums are otherwise
+        detected through the generation stored in the database.
+    """
+
+    with _tree_lock:
+        _tree["snapshot"] = None
+        _tree["html"] = collections.OrderedDict()
+
+    shared = flask.current_app.config["tree_cache"]
+    if shared is not None:
+        shared.delete("redmill.tree.snapshot")
+
+def get_tree_snapshot():
+    """ Return the album hierarchy as a dictionary mapping a parent id to the
+        (id, name) of its child albums. The snapshot is built from a single
+        query and cached until the generation of the hierarchy changes, which
+        costs one query per call.
+    """
+
+    session = redmill.database.Session()
+    try:
+        generation = redmill.models.tree_version.get_generation(
+            session.connection())
+
+        with _tree_lock:
+            if (
+                    _tree["snapshot"] is not None
+                    and _tree["snapshot"][0] == generation):
+                return _tree["snapshot"][1]
+
+        shared = flask.current_app.config["tree_cache"]
+        snapshot = None
+        if shared is not None:
+            value = shared.get("redmill.tree.snapshot")
+            if value is not None and value[0] == generation:
+                snapshot = value[1]
+
+        if snapshot is None:
+            album = redmill.models.Album
+            snapshot = {}
+            for id_, name, parent_id in session.query(
+                        album.id, album.name, album.parent_id)\
+                    .order_by(album.rank, album.id):
+                snapshot.setdefault(parent_id, []).append((id_, name))
+
+            if shared is not None:
+                shared.set("redmill.tree.snapshot", (generation, snapshot))
+    finally:
+        session.close()
+
+    with _tree_lock:
+        _tree["snapshot"] = (generation, snapshot)
+        _tree["html"] = collections.OrderedDict()
+
+    return snapshot
+
 def get_tree(limit):
+    """ Return the HTML tree of the albums, the album with id limit and its
+        descendants being disabled.
+    """
+
+    children = get_tree_snapshot()
+    with _tree_lock:
+        if _tree["snapshot"][1] is children and limit in _tree["html"]:
+            return _tree["html"][limit]
 
     def get_children_list(album, mode, top_level=True, disabled=False):
-        if mode=="album" or album.id:
-            onclick = "onclick=\"alert('{}');\"".format(album.id)
+        id_, name = album
+        if mode=="album" or id_:
+            onclick = "onclick=\"alert('{}');\"".format(id_)
             class_ = "enabled"
         else:
             onclick = ""
             class_ = "disabled"
 
-        if album.id == limit:
+        if id_ == limit:
             disabled = True
         result = u"<span class=\"{}\" data-rm-id=\"{}\" {}>{}</span>".format(
-            class_, album.id or "", "disabled=\"disabled\"" if disabled else "",
-            album.name)
+            class_, id_ or "", "disabled=\"disabled\"" if disabled else "",
+            name)
 
-        children = [
+        children_list = [
             u"<li>{}</li>".format(get_children_list(x, mode, False, disabled))
-            for x in album.children if x.type == "album"]
-        if children:
-            result += u"<ul>{}</ul>".format("".join(children))
+            for x in children.get(id_, [])]
+        if children_list:
+            result += u"<ul>{}</ul>".format("".join(children_list))
 
         return (u"<ul class=\"tree\"><li>{}</li></ul>" if top_level else u"{}").format(result)
 
     # Display it somehow on the left to make a move widget
     # Same code for media and album
 
-    return get_children_list(redmill.models.Album.get_toplevel(), "album")
+    toplevel = redmill.models.Album.get_toplevel(False)
+    html = get_children_list((toplevel.id, toplevel.name), "album")
+
+    with _tree_lock:
+        if _tree["snapshot"][1] is children:
+            _tree["html"][limit] = html
+            while len(_tree["html"]) > _tree_html_size:
+                _tree["html"].popitem(last=False)
+
+    return html
@@ -13,23 +13,39 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
-import io
 import json
 import os
 
 import flask
-import PIL.Image
 
-from .. import database, magic, models, processor
+from .. import database, models, render
 
-from . import authenticate, get_item, jsonify, request_wants_json
+from . import (
+    authenticate, get_cache, get_content_validators, get_ids, get_item,
+    get_validation_headers, is_not_modified, jsonify, prerender,
+    request_wants_json)
 
 def get_all(media_id):
+    """ Return the URLs of the derivatives of the media or, if the "ids"
+        parameter is present, the requested derivatives, skipping the missing
+        ones.
+    """
+
     session = database.Session()
 
     # Make sure the request media exists.
     media = get_item(session, models.Media, media_id)
 
+    if "ids" in flask.request.args:
+        ids = get_ids()
+        derivatives = session.query(models.Derivative)\
+            .filter(
+                models.Derivative.media_id == media_id,
+                models.Derivative.id.in_(set(ids)))\
+            .all()
+        derivatives = {x.id: x for x in derivatives}
+        return jsonify([derivatives.pop(x) for x in ids if x in derivatives])
+
     derivatives = session.query(
         models.Derivative).filter_by(media_id=media_id).all()
 
@@ -76,6 +92,8 @@ def post(media_id):
         session.rollback()
         flask.abort(500, e)
 
+    prerender(media.id, [(derivative.id, derivative.operations)])
+
     view = __name__.split(".")[-1]
     endpoint = "{}.get".format(view)
     location = flask.url_for(endpoint, media_id=media.id, id_=derivative.id, _method="GET")
@@ -103,11 +121,12 @@ def delete(media_id, id_):
             session.rollback()
             flask.abort(500, e)
         session.commit()
+        get_cache().invalidate(media_id, id_)
         return "", 204 # No content
 
 def as_html(derivative):
     parents = (
-        [models.Album.get_toplevel()]+
+        [models.Album.get_toplevel(False)]+
         derivative.media.parents+[derivative.media])
     return flask.render_template(
         "derivative.html", derivative=derivative,
@@ -127,24 +146,54 @@ def get_content(media_id, derivative_id):
     if derivative is None:
         flask.abort(404)
 
-    # FIXME: this should be cached!
+    quality = flask.current_app.config["render_quality"]
+    etag, last_modified = get_content_validators(
+        derivative.media, derivative.id, derivative.operations, quality)
+    headers = get_validation_headers(etag, last_modified)
+    if is_not_modified(etag, last_modified):
+        return "", 304, headers
+
     filename = os.path.join(
         flask.current_app.config["media_directory"],
-        "{}".format(derivative.media.id))
-    image = PIL.Image.open(filename)
-
-    thumbnail = processor.apply(derivative.operations, image)
+        "{}".format(derivative.media_id))
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        flask.abort(404)
 
-    data = io.BytesIO()
-    thumbnail.save(data, format="PNG")
-    data = data.getvalue()
+    cache = get_cache()
+    data = cache.get(
+        media_id, derivative_id, derivative.operations, mtime, quality)
+    if data is None:
+        executor = flask.current_app.config["render_executor"]
+        try:
+            data = executor.render(filename, derivative.operations, quality)
+        except (render.Busy, render.Timeout):
+            flask.abort(503)
+        cache.put(
+            media_id, derivative_id, derivative.operations, mtime, data,
+            quality)
 
-    headers = {
-        "Content-Type": magic.buffer(data),
-    }
+    headers["Content-Type"] = "image/png"
 
     return data, 200, headers
 
+def is_warm(derivative):
+    """ Test whether the content of the derivative is cached.
+    """
+
+    filename = os.path.join(
+        flask.current_app.config["media_directory"],
+        "{}".format(derivative.media_id))
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return False
+
+    return get_cache().contains(
+        derivative.media_id, derivative.id, derivative.operations, mtime,
+        flask.current_app.config["render_quality"])
+
 def _update(media_id, id_):
     try:
         data = json.loads(flask.request.data)
@@ -171,4 +220,7 @@ def _update(media_id, id_):
 
     session.commit()
 
+    get_cache().invalidate(media_id, id_)
+    prerender(media_id, [(derivative.id, derivative.operations)])
+
     return flask.json.dumps(derivative)
@@ -0,0 +1,98 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+import flask
+
+from .. import database, importer, models, serializer
+from . import authenticate, jsonify
+
+@authenticate()
+def post():
+    """ Import files of the import directory, described by a JSON manifest:
+        {
+            "items": [{"path": ..., "name": ..., "author": ...,
+                "keywords": ...}, ...],
+            "parent_id": ..., "author": ..., "link": ...
+        }
+        Only the paths (relative to the import directory) are required, cf.
+        redmill.importer.import_files for the other members.
+    """
+
+    config = flask.current_app.config
+    if config["import_directory"] is None:
+        flask.abort(404)
+
+    try:
+        data = json.loads(flask.request.data.decode("utf-8"))
+    except:
+        flask.abort(400)
+
+    if not isinstance(data, dict) or not isinstance(data.get("items"), list):
+        flask.abort(400)
+    entries = data["items"]
+    if not all(_is_valid_entry(x) for x in entries):
+        flask.abort(400)
+    parent_id = data.get("parent_id")
+    if parent_id is not None and (
+            not isinstance(parent_id, int) or isinstance(parent_id, bool)):
+        flask.abort(400)
+    if not isinstance(data.get("author", u""), _string):
+        flask.abort(400)
+
+    session = database.Session()
+    if (
+            parent_id is not None
+            and session.query(models.Album).get(parent_id) is None):
+        flask.abort(404)
+
+    def progress(imported, total):
+        flask.current_app.logger.info(
+            "%d/%d media imported", imported, total)
+
+    try:
+        ids = importer.import_files(
+            session, config["media_directory"], config["import_directory"],
+            entries, parent_id, data.get("author", u""),
+            bool(data.get("link", False)),
+            workers=config["import_workers"], progress=progress)
+    except ValueError as e:
+        flask.abort(400, e)
+
+    template = serializer.get_url_template("media.get", "id_")
+    return jsonify([template.format(id_=x) for x in ids], 201)
+
+# Type of the strings decoded from JSON (unicode in Python 2)
+_string = type(u"")
+
+def _is_valid_entry(entry):
+    """ Test whether an entry of the manifest has a path and members of the
+        expected types.
+    """
+
+    if not isinstance(entry, dict):
+        return False
+    if not isinstance(entry.get("path"), _string):
+        return False
+    for name in ["name", "author"]:
+        if name in entry and not isinstance(entry[name], _string):
+            return False
+    keywords = entry.get("keywords")
+    if keywords is not None and not (
+            isinstance(keywords, list)
+            and all(isinstance(x, _string) for x in keywords)):
+        return False
+    return True
@@ -23,29 +23,25 @@ import flask.json
 
 from .. import database, models
 from . import (
-    authenticate, get_item, jsonify, request_wants_json, get_children_filter,
-    get_tree)
+    authenticate, get_cache, get_item, get_items, get_ids, jsonify, request_wants_json,
+    get_children_filter, get_request_content, get_tree, upload_content)
 
 def as_html(media, parents, creation=False):
-    filename = os.path.join(
-        flask.current_app.config["media_directory"],
-        "{}".format(media.id))
-
-    if os.path.isfile(filename):
-        size = os.path.getsize(filename)
+    if media.size is not None:
+        size = media.size
         prefixes = iter(["", "k", "M", "G", "T", "P", "E", "Z"])
         while size >= 1024:
             size /= 1024.
-            prefixes.next()
+            next(prefixes)
 
-        size = "{} {}B".format(int(size), prefixes.next())
+        size = "{} {}B".format(int(size), next(prefixes))
     else:
         size = "(none)"
 
     parameters = {
         "media": media, "size": size,
-        "parents": [models.Album.get_toplevel()]+parents, "creation": creation,
-        "tree": get_tree(media.parent.id)
+        "parents": [models.Album.get_toplevel(False)]+parents, "creation": creation,
+        "tree": get_tree(media.parent_id)
     }
     return flask.render_template("media.html", **parameters)
 
@@ -58,20 +54,38 @@ def get(id_):
     else:
         return as_html(media, media.parents)
 
+def get_many():
+    """ Return the media whose ids are given in the "ids" parameter, skipping
+        the missing and hidden ones.
+    """
+
+    session = database.Session()
+    return jsonify(get_items(session, models.Media, get_ids()))
+
 @authenticate()
 def post():
     session = database.Session()
 
-    try:
-        data = json.loads(flask.request.data.decode("utf-8"))
-    except:
-        flask.abort(400)
-
-    fields = ["name", "author", "content", "parent_id"]
-    if any(field not in data for field in fields):
+    content = get_request_content()
+    if content is None:
+        # Legacy upload: base64-encoded content in a JSON object
+        try:
+            data = json.loads(flask.request.data.decode("utf-8"))
+        except:
+            flask.abort(400)
+        if "content" in data:
+            content = base64.b64decode(data["content"])
+    else:
+        # Streamed upload: metadata in the form or in the query string
+        if flask.request.mimetype == "multipart/form-data":
+            data = _get_metadata(flask.request.form)
+        else:
+            data = _get_metadata(flask.request.args)
+
+    fields = ["name", "author", "parent_id"]
+    if content is None or any(field not in data for field in fields):
         flask.abort(400)
 
-    content = base64.b64decode(data["content"])
     if session.query(models.Album).get(data["parent_id"]) is None:
         flask.abort(404)
 
@@ -83,17 +97,25 @@ def post():
 
     if "keywords" in data:
         arguments["keywords"] = data["keywords"]
-    arguments["filename"] = database.get_filesystem_path(data["name"], content)
+
+    try:
+        upload = upload_content(content)
+    except Exception as e:
+        flask.abort(500, e)
 
     try:
         media = models.Media(**arguments)
+        media.set_content_info(upload.info)
+        media.filename = database.get_filesystem_path(
+            media.name, mime_type=media.mime_type)
         session.add(media)
-        session.commit()
+        session.flush()
 
-        filename = os.path.join(flask.current_app.config["media_directory"], "{}".format(media.id))
-        with open(filename, "wb") as fd:
-            fd.write(content)
+        upload.commit(os.path.join(
+            flask.current_app.config["media_directory"], "{}".format(media.id)))
+        session.commit()
     except Exception as e:
+        upload.abort()
         session.rollback()
         flask.abort(500, e)
 
@@ -127,6 +149,7 @@ def delete(id_):
             session.rollback()
             flask.abort(500, e)
         session.commit()
+        get_cache().invalidate(id_)
         return "", 204 # No content
 
 @authenticate()
@@ -140,9 +163,25 @@ def create(parent_id):
 
     media = models.Media(
         id=None, parent_id=parent_id, name="", author="",
-        rank=len(album.children))
+        rank=session.query(models.Item).filter_by(parent_id=parent_id).count())
     return as_html(media, parents, True)
 
+def _get_metadata(values):
+    """ Return the media metadata from the values of a form or of a query
+        string.
+    """
+
+    data = {
+        field: values[field] for field in ["name", "author"] if field in values}
+    if "parent_id" in values:
+        try:
+            data["parent_id"] = int(values["parent_id"])
+        except ValueError:
+            flask.abort(400)
+    if "keywords" in values:
+        data["keywords"] = values.getlist("keywords")
+    return data
+
 def _update(id_):
     fields = ["name", "author", "keywords", "parent_id", "status"]
 
@@ -20,7 +20,10 @@ import os
 import flask
 
 from .. import database, magic, models
-from . import authenticate, jsonify, request_wants_json
+from . import (
+    authenticate, get_cache, get_content_validators, get_request_content,
+    get_validation_headers, is_not_modified, jsonify, prerender,
+    request_wants_json, send_file, upload_content)
 
 def get(id_):
     session = database.Session()
@@ -28,16 +31,26 @@ def get(id_):
     if media is None:
         flask.abort(404)
 
+    etag, last_modified = get_content_validators(media)
+    headers = get_validation_headers(etag, last_modified)
+    if is_not_modified(etag, last_modified):
+        return "", 304, headers
+
     filename = os.path.join(flask.current_app.config["media_directory"], "{}".format(media.id))
-    with open(filename, "rb") as fd:
-        data = fd.read()
+    if not os.path.isfile(filename):
+        flask.abort(404)
+
+    mime_type = media.mime_type
+    if mime_type is None:
+        # Media stored before the content information was recorded (cf.
+        # redmill update-content-info): only guess the type
+        with open(filename, "rb") as fd:
+            mime_type = magic.buffer(fd.read(65536)).decode("utf-8")
 
-    headers = {
-        "Content-Type": magic.buffer(data),
-        "Content-Disposition": "attachment; filename=\"{}\"".format(media.filename)
-    }
+    headers["Content-Disposition"] = "attachment; filename=\"{}\"".format(
+        media.filename)
 
-    return data, 200, headers
+    return send_file(filename, mime_type, headers, etag, last_modified)
 
 @authenticate()
 def put(id_):
@@ -49,15 +62,27 @@ def _update(id_):
     if media is None:
         flask.abort(404)
 
-    content = base64.b64decode(flask.request.data)
+    content = get_request_content()
+    if content is None:
+        # Legacy upload: base64-encoded body
+        content = base64.b64decode(flask.request.data)
 
-    filename = os.path.join(flask.current_app.config["media_directory"], "{}".format(media.id))
-    with open(filename, "wb") as fd:
-        fd.write(content)
+    upload = upload_content(content)
+    try:
+        media.set_content_info(upload.info)
+        upload.commit(os.path.join(
+            flask.current_app.config["media_directory"], "{}".format(media.id)))
+    except:
+        upload.abort()
+        raise
 
-    media.filename = database.get_filesystem_path(media.name, content)
+    media.filename = database.get_filesystem_path(
+        media.name, mime_type=media.mime_type)
     media.modified_at = datetime.datetime.now()
 
     session.commit()
 
+    get_cache().invalidate(media.id)
+    prerender(media.id, [(x.id, x.operations) for x in media.derivatives])
+
     return flask.json.dumps(media)
@@ -0,0 +1,180 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import flask
+import flask.json
+import sqlalchemy.exc
+import werkzeug.http
+
+from .. import database, models, upload as upload_
+from . import authenticate, jsonify
+
+@authenticate()
+def get(id_):
+    session = database.Session()
+    upload = _get_upload(session, id_)
+    return jsonify(upload)
+
+@authenticate()
+def post():
+    try:
+        data = json.loads(flask.request.data.decode("utf-8"))
+    except:
+        flask.abort(400)
+
+    fields = ["name", "author", "parent_id", "size"]
+    if any(field not in data for field in fields):
+        flask.abort(400)
+    if not isinstance(data["size"], int) or data["size"] < 0:
+        flask.abort(400)
+
+    session = database.Session()
+    if session.query(models.Album).get(data["parent_id"]) is None:
+        flask.abort(404)
+
+    arguments = {field: data[field] for field in fields}
+    if "keywords" in data:
+        arguments["keywords"] = data["keywords"]
+
+    try:
+        upload = models.UploadSession(**arguments)
+        session.add(upload)
+        session.flush()
+
+        # Preallocate the file so that chunks can be written in any order
+        with open(_get_path(upload), "wb") as fd:
+            fd.truncate(upload.size)
+
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        flask.abort(500, e)
+
+    view = __name__.split(".")[-1]
+    endpoint = "{}.get".format(view)
+    location = flask.url_for(endpoint, id_=upload.id, _method="GET")
+    return flask.json.dumps(upload), 201, { "Location": location }
+
+@authenticate()
+def put(id_):
+    """ Write the body of the request at the position given by its
+        Content-Range header, e.g. "bytes 0-1048575/10485760".
+    """
+
+    session = database.Session()
+    upload = _get_upload(session, id_)
+
+    content_range = werkzeug.http.parse_content_range_header(
+        flask.request.headers.get("Content-Range"))
+    if content_range is None or content_range.units != "bytes":
+        flask.abort(400)
+    if content_range.start is None or content_range.stop is None:
+        # e.g. "bytes */10485760": no content
+        flask.abort(400)
+    if content_range.length not in [None, "*", upload.size]:
+        flask.abort(400)
+    if content_range.stop > upload.size:
+        flask.abort(416)
+
+    offset = content_range.start
+    length = content_range.stop-content_range.start
+    written = upload_.write_range(
+        _get_path(upload), offset, flask.request.stream, length)
+    if written != length:
+        # Incomplete chunk: it must be sent again
+        flask.abort(400)
+
+    chunk = session.query(models.UploadChunk).get((upload.id, offset, length))
+    if chunk is None:
+        try:
+            upload.chunks.append(
+                models.UploadChunk(offset=offset, length=length))
+            session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Same chunk concurrently received
+            session.rollback()
+
+    return jsonify(upload)
+
+@authenticate()
+def delete(id_):
+    session = database.Session()
+    upload = _get_upload(session, id_)
+
+    try:
+        os.remove(_get_path(upload))
+    except OSError:
+        pass
+    session.delete(upload)
+    session.commit()
+
+    return "", 204 # No content
+
+@authenticate()
+def finalize(id_):
+    """ Create the media from a complete upload.
+    """
+
+    session = database.Session()
+    upload = _get_upload(session, id_)
+
+    if not upload.complete:
+        flask.abort(409)
+    if session.query(models.Album).get(upload.parent_id) is None:
+        flask.abort(404)
+
+    path = _get_path(upload)
+    destination = None
+    try:
+        media = models.Media(
+            name=upload.name, author=upload.author, keywords=upload.keywords,
+            parent_id=upload.parent_id)
+        media.set_content_info(database.get_content_info(path))
+        media.filename = database.get_filesystem_path(
+            media.name, mime_type=media.mime_type)
+        session.add(media)
+        session.delete(upload)
+        session.flush()
+
+        destination = os.path.join(
+            flask.current_app.config["media_directory"], "{}".format(media.id))
+        os.rename(path, destination)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        if destination is not None and os.path.isfile(destination):
+            # Keep the content with the upload session
+            os.rename(destination, path)
+        flask.abort(500, e)
+
+    location = flask.url_for("media.get", id_=media.id, _method="GET")
+    return flask.json.dumps(media), 201, { "Location": location }
+
+def _get_upload(session, id_):
+    upload = session.query(models.UploadSession).get(id_)
+    if upload is None:
+        flask.abort(404)
+    return upload
+
+def _get_path(upload):
+    """ Path of the content of an upload session.
+    """
+
+    return os.path.join(
+        flask.current_app.config["media_directory"],
+        ".session-{}".format(upload.id))
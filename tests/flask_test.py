@@ -31,6 +31,9 @@ class FlaskTest(database_test.DatabaseTest):
         self.context.push()
         redmill.controller.app.config["media_directory"] = tempfile.mkdtemp()
         redmill.controller.app.config["SECRET_KEY"] = "deadbeef"
+        redmill.controller.app.config["render_queue"] = redmill.tasks.LocalQueue()
+        # The database is new: discard the cached album tree
+        redmill.views.invalidate_tree()
 
     def tearDown(self):
         shutil.rmtree(redmill.controller.app.config["media_directory"])
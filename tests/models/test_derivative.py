@@ -49,5 +49,37 @@ class TestDerivative(DatabaseTest):
         self.assertEqual(derivatives[0].media, self.media)
         self.assertEqual(self.media.derivatives[0], derivatives[0])
 
+    def test_id_allocation(self):
+        derivatives = [
+            redmill.models.Derivative(self.media, [("resize", (40,))]),
+            redmill.models.Derivative(self.media.id, [("resize", (20,))])
+        ]
+        self.session.add_all(derivatives)
+        self.session.commit()
+
+        self.assertEqual(sorted(x.id for x in derivatives), [1, 2])
+
+        # Allocated ids are not reused
+        self.session.delete(derivatives[1])
+        self.session.commit()
+        derivative = redmill.models.Derivative(self.media, [("resize", (10,))])
+        self.session.add(derivative)
+        self.session.commit()
+        self.assertEqual(derivative.id, 3)
+
+    def test_id_allocation_rollback(self):
+        derivative = redmill.models.Derivative(self.media, [("resize", (40,))])
+        self.session.add(derivative)
+        self.session.flush()
+        self.session.rollback()
+
+        self.session.expire_all()
+        self.assertEqual(self.media.next_derivative, 1)
+
+        derivative = redmill.models.Derivative(self.media, [("resize", (40,))])
+        self.session.add(derivative)
+        self.session.commit()
+        self.assertEqual(derivative.id, 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,8 @@ import os
 import unittest
 import sys
 
+import sqlalchemy
+
 import redmill.database
 import redmill.models
 
@@ -53,6 +55,225 @@ class TestItem(DatabaseTest):
         self.session.commit()
 
         self.assertEqual(baz.parents, [foo, bar])
+        self.assertEqual(bar.parents, [foo])
+        self.assertEqual(foo.parents, [])
+
+    def test_path(self):
+        foo = redmill.models.Item(name=u"foo")
+        self.session.add(foo)
+        self.session.commit()
+
+        bar = redmill.models.Item(name=u"bar", parent_id=foo.id)
+        self.session.add(bar)
+        self.session.commit()
+
+        baz = redmill.models.Item(name=u"baz", parent_id=bar.id)
+        self.session.add(baz)
+        self.session.commit()
+
+        self.assertEqual(foo.path, "/{}/".format(foo.id))
+        self.assertEqual(bar.path, "/{}/{}/".format(foo.id, bar.id))
+        self.assertEqual(baz.path, "/{}/{}/{}/".format(foo.id, bar.id, baz.id))
+
+        self.assertEqual(foo.get_descendants().all(), [baz, bar])
+        self.assertEqual(baz.get_descendants().all(), [])
+
+    def test_move(self):
+        foo = redmill.models.Item(name=u"foo")
+        qux = redmill.models.Item(name=u"qux")
+        self.session.add_all([foo, qux])
+        self.session.commit()
+
+        bar = redmill.models.Item(name=u"bar", parent_id=foo.id)
+        self.session.add(bar)
+        self.session.commit()
+
+        baz = redmill.models.Item(name=u"baz", parent_id=bar.id)
+        self.session.add(baz)
+        self.session.commit()
+
+        bar.parent_id = qux.id
+        self.session.commit()
+
+        self.assertEqual(bar.path, "/{}/{}/".format(qux.id, bar.id))
+        self.assertEqual(baz.path, "/{}/{}/{}/".format(qux.id, bar.id, baz.id))
+        self.assertEqual(baz.parents, [qux, bar])
+        self.assertEqual(foo.get_descendants().all(), [])
+
+        bar.parent_id = None
+        self.session.commit()
+
+        self.assertEqual(bar.path, "/{}/".format(bar.id))
+        self.assertEqual(baz.path, "/{}/{}/".format(bar.id, baz.id))
+
+    def test_update_paths(self):
+        foo = redmill.models.Item(name=u"foo")
+        self.session.add(foo)
+        self.session.commit()
+
+        bar = redmill.models.Item(name=u"bar", parent_id=foo.id)
+        self.session.add(bar)
+        self.session.commit()
+
+        baz = redmill.models.Item(name=u"baz", parent_id=bar.id)
+        self.session.add(baz)
+        self.session.commit()
+
+        # Database without paths
+        self.session.query(redmill.models.Item).update({"path": None})
+        self.session.commit()
+
+        self.assertEqual(baz.parents, [foo, bar])
+        self.assertEqual(foo.get_descendants().all(), [baz, bar])
+
+        self.assertEqual(
+            redmill.models.item.update_paths(self.session.connection()), 3)
+        self.session.commit()
+        self.assertEqual(baz.path, "/{}/{}/{}/".format(foo.id, bar.id, baz.id))
+
+        self.assertEqual(
+            redmill.models.item.update_paths(self.session.connection()), 0)
+
+    def _insert_tree(self):
+        foo = redmill.models.Item(name=u"foo")
+        qux = redmill.models.Item(name=u"qux")
+        self.session.add_all([foo, qux])
+        self.session.commit()
+
+        bar = redmill.models.Item(name=u"bar", parent_id=foo.id)
+        self.session.add(bar)
+        self.session.commit()
+
+        baz = redmill.models.Item(name=u"baz", parent_id=bar.id)
+        self.session.add(baz)
+        self.session.commit()
+
+        return foo, bar, baz, qux
+
+    def _get_visibility(self, *items):
+        self.session.expire_all()
+        return [x.visible for x in items]
+
+    def test_visible(self):
+        foo, bar, baz, qux = self._insert_tree()
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux), [True]*4)
+
+        foo.status = "archived"
+        self.session.commit()
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux),
+            [False, False, False, True])
+
+        bar.status = "archived"
+        self.session.commit()
+        foo.status = "published"
+        self.session.commit()
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux),
+            [True, False, False, True])
+
+        item = redmill.models.Item(name=u"item", parent_id=bar.id)
+        self.session.add(item)
+        self.session.commit()
+        self.assertEqual(self._get_visibility(item), [False])
+
+        qux.status = "archived"
+        self.session.commit()
+        baz.parent_id = qux.id
+        bar.status = "published"
+        self.session.commit()
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux, item),
+            [True, True, False, False, True])
+        self.assertFalse(baz.is_visible())
+        self.assertTrue(item.is_visible())
+
+    def test_visible_queries(self):
+        foo, bar, baz, qux = self._insert_tree()
+        children = [
+            redmill.models.Item(
+                name=u"child {}".format(index), parent_id=baz.id,
+                status="archived" if index%2 else "published")
+            for index in range(4)]
+        self.session.add_all(children)
+        self.session.commit()
+        grandchild = redmill.models.Item(
+            name=u"grandchild", parent_id=children[1].id)
+        self.session.add(grandchild)
+        foo.status = "archived"
+        self.session.commit()
+
+        statements = []
+        def count(connection, cursor, statement, *args):
+            if statement.startswith("UPDATE item SET visible"):
+                statements.append(statement)
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            foo.status = "published"
+            self.session.commit()
+        finally:
+            sqlalchemy.event.remove(self.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux, grandchild, *children),
+            [True, True, True, True, False, True, False, True, False])
+
+    def test_visible_without_path(self):
+        foo, bar, baz, qux = self._insert_tree()
+        self.session.query(redmill.models.Item).update({"path": None})
+        self.session.commit()
+
+        foo.status = "archived"
+        self.session.commit()
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux),
+            [False, False, False, True])
+
+    def test_update_visibility(self):
+        foo, bar, baz, qux = self._insert_tree()
+        bar.status = "archived"
+        self.session.commit()
+
+        self.session.query(redmill.models.Item).update({"visible": None})
+        self.session.commit()
+        self.assertFalse(baz.is_visible())
+        self.assertTrue(qux.is_visible())
+
+        self.assertEqual(
+            redmill.models.item.update_visibility(self.session.connection()),
+            4)
+        self.session.commit()
+        self.assertEqual(
+            self._get_visibility(foo, bar, baz, qux),
+            [True, False, False, True])
+
+    def test_parents_single_query(self):
+        parent_id = None
+        items = []
+        for index in range(5):
+            item = redmill.models.Item(
+                name=u"item {}".format(index), parent_id=parent_id)
+            self.session.add(item)
+            self.session.commit()
+            items.append(item)
+            parent_id = item.id
+        self.session.expire_all()
+        leaf = self.session.query(redmill.models.Item).get(parent_id)
+
+        statements = []
+        def count(*args):
+            statements.append(args)
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            parents = leaf.parents
+        finally:
+            sqlalchemy.event.remove(self.engine, "before_cursor_execute", count)
+
+        self.assertEqual(
+            [x.id for x in parents], [x.id for x in items[:-1]])
+        self.assertEqual(len(statements), 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import redmill.cache
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = redmill.cache.Cache(self.directory)
+        self.operations = [["resize", {"width": 10}]]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), None)
+        self.assertFalse(self.cache.contains(1, 1, self.operations, 0))
+
+    def test_put(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+        self.assertTrue(self.cache.contains(1, 1, self.operations, 0))
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), b"foo")
+
+    def test_key(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+
+        self.assertEqual(self.cache.get(2, 1, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 2, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 1, [], 0), None)
+        self.assertEqual(self.cache.get(1, 1, self.operations, 1), None)
+
+    def test_quality(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo", "normal")
+        self.cache.put(1, 1, self.operations, 0, b"bar", "high")
+
+        self.assertEqual(
+            self.cache.get(1, 1, self.operations, 0, "normal"), None)
+        self.assertEqual(
+            self.cache.get(1, 1, self.operations, 0, "high"), b"bar")
+        self.assertFalse(self.cache.contains(1, 1, self.operations, 0, "low"))
+
+    def test_replace(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+        self.cache.put(1, 1, self.operations, 1, b"bar")
+
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 1, self.operations, 1), b"bar")
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.directory, "1"))), 1)
+
+    def test_invalidate_derivative(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+        self.cache.put(1, 2, self.operations, 0, b"bar")
+
+        self.cache.invalidate(1, 1)
+
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 2, self.operations, 0), b"bar")
+
+    def test_invalidate_media(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+        self.cache.put(1, 2, self.operations, 0, b"bar")
+        self.cache.put(2, 1, self.operations, 0, b"baz")
+
+        self.cache.invalidate(1)
+
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 2, self.operations, 0), None)
+        self.assertEqual(self.cache.get(2, 1, self.operations, 0), b"baz")
+
+    def test_detach(self):
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+
+        directory = self.cache.detach(1)
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), None)
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(self.cache.detach(2), None)
+
+        # New entries of the same media are kept
+        self.cache.put(1, 1, self.operations, 0, b"bar")
+        self.cache.remove_detached(directory)
+        self.assertFalse(os.path.isdir(directory))
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), b"bar")
+
+    def test_eviction(self):
+        self.cache.max_size = 6
+
+        self.cache.put(1, 1, self.operations, 0, b"foo")
+        self.cache.put(1, 2, self.operations, 0, b"bar")
+
+        # Make the first entry the most recently used one
+        past = time.time()-10
+        os.utime(
+            self.cache._get_path(1, 2, self.operations, 0, "normal"),
+            (past, past))
+        self.cache.get(1, 1, self.operations, 0)
+
+        self.cache.put(1, 3, self.operations, 0, b"baz")
+
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), b"foo")
+        self.assertEqual(self.cache.get(1, 2, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 3, self.operations, 0), b"baz")
+
+    def test_eviction_walks(self):
+        self.cache.max_size = 9
+
+        walks = []
+        walk = os.walk
+        def counting_walk(*args, **kwargs):
+            walks.append(args)
+            return walk(*args, **kwargs)
+        redmill.cache.os.walk = counting_walk
+        try:
+            # The first write computes the size of the cache
+            self.cache.put(1, 1, self.operations, 0, b"foo")
+            self.assertEqual(len(walks), 1)
+
+            # Below the maximum size: no walk
+            self.cache.put(1, 2, self.operations, 0, b"bar")
+            self.cache.put(1, 2, self.operations, 1, b"bar")
+            self.cache.invalidate(1, 2)
+            self.cache.put(1, 3, self.operations, 0, b"baz")
+            self.assertEqual(len(walks), 1)
+
+            # Above the maximum size: walk and evict
+            self.cache.put(1, 4, self.operations, 0, b"quux")
+            self.assertEqual(len(walks), 2)
+        finally:
+            redmill.cache.os.walk = walk
+
+        self.assertEqual(self.cache.get(1, 1, self.operations, 0), None)
+        self.assertEqual(self.cache.get(1, 4, self.operations, 0), b"quux")
+
+if __name__ == "__main__":
+    unittest.main()
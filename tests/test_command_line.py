@@ -0,0 +1,121 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy
+
+import redmill.command_line
+import redmill.models
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = "sqlite:///{}".format(
+            os.path.join(self.directory, "redmill.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_upgrade(self):
+        engine = sqlalchemy.create_engine(self.url)
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "CREATE TABLE item ("
+                    "id INTEGER PRIMARY KEY, name VARCHAR, type VARCHAR, "
+                    "parent_id INTEGER)"))
+            connection.execute(sqlalchemy.text(
+                "INSERT INTO item VALUES "
+                    "(1, 'foo', 'album', NULL), (2, 'bar', 'album', 1)"))
+
+        self.assertEqual(redmill.command_line.main(["upgrade", self.url]), 0)
+
+        inspector = sqlalchemy.inspect(engine)
+        self.assertTrue(
+            "ix_item_path" in [x["name"] for x in inspector.get_indexes("item")])
+        with engine.begin() as connection:
+            paths = connection.execute(sqlalchemy.text(
+                "SELECT id, path, visible FROM item ORDER BY id")).fetchall()
+        self.assertEqual(
+            [tuple(x) for x in paths], [(1, "/1/", 1), (2, "/1/2/", 1)])
+
+        engine.dispose()
+
+    def test_update_content_info(self):
+        media_directory = os.path.join(self.directory, "media")
+        os.makedirs(media_directory)
+        shutil.copyfile(
+            os.path.join(os.path.dirname(__file__), "image.jpg"),
+            os.path.join(media_directory, "2"))
+
+        engine = sqlalchemy.create_engine(self.url)
+        redmill.models.Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "INSERT INTO item (id, name, type, parent_id) VALUES "
+                    "(1, 'foo', 'album', NULL), (2, 'bar', 'media', 1), "
+                    "(3, 'baz', 'media', 1)"))
+            connection.execute(sqlalchemy.text(
+                "INSERT INTO media (id, author) VALUES (2, 'a'), (3, 'a')"))
+
+        self.assertEqual(
+            redmill.command_line.main(
+                ["upgrade", self.url, "--media-directory", media_directory]),
+            0)
+
+        with engine.begin() as connection:
+            media = connection.execute(sqlalchemy.text(
+                "SELECT id, mime_type, size FROM media ORDER BY id")).fetchall()
+        size = os.path.getsize(os.path.join(media_directory, "2"))
+        # Missing files are skipped
+        self.assertEqual(
+            [tuple(x) for x in media],
+            [(2, "image/jpeg", size), (3, None, None)])
+
+        engine.dispose()
+
+    def test_import(self):
+        source = os.path.join(self.directory, "source")
+        media_directory = os.path.join(self.directory, "media")
+        os.makedirs(os.path.join(source, "album"))
+        os.makedirs(media_directory)
+        shutil.copyfile(
+            os.path.join(os.path.dirname(__file__), "image.jpg"),
+            os.path.join(source, "album", "image.jpg"))
+
+        engine = sqlalchemy.create_engine(self.url)
+        redmill.models.Base.metadata.create_all(engine)
+
+        self.assertEqual(
+            redmill.command_line.main([
+                "import", self.url, media_directory, source, "--author", "Foo",
+                "--workers", "0"]),
+            0)
+
+        with engine.begin() as connection:
+            items = connection.execute(sqlalchemy.text(
+                "SELECT id, name, type FROM item ORDER BY id")).fetchall()
+        self.assertEqual(
+            [tuple(x) for x in items],
+            [(1, "album", "album"), (2, "image.jpg", "media")])
+        self.assertEqual(os.listdir(media_directory), ["2"])
+
+        engine.dispose()
+
+if __name__ == "__main__":
+    unittest.main()
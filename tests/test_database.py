@@ -0,0 +1,164 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy
+import sqlalchemy.orm
+
+import redmill.database
+import redmill.models
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_content_info(self):
+        filename = os.path.join(os.path.dirname(__file__), "image.jpg")
+        content = open(filename, "rb").read()
+
+        info = redmill.database.get_content_info(filename, 1024)
+        self.assertEqual(info["mime_type"], "image/jpeg")
+        self.assertEqual(info["size"], len(content))
+        self.assertTrue(info["width"] > 0 and info["height"] > 0)
+        self.assertEqual(
+            info["content_hash"], hashlib.sha256(content).hexdigest())
+
+    def test_content_info_not_image(self):
+        filename = os.path.join(self.directory, "foo")
+        with open(filename, "wb") as fd:
+            fd.write(b"foobar")
+
+        info = redmill.database.get_content_info(filename)
+        self.assertEqual(info["mime_type"], "text/plain")
+        self.assertEqual(info["size"], 6)
+        self.assertEqual(info["width"], None)
+        self.assertEqual(info["height"], None)
+
+    def test_upgrade(self):
+        engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "CREATE TABLE media (id INTEGER PRIMARY KEY, filename VARCHAR)"))
+
+        redmill.database.upgrade(engine, redmill.models.Base.metadata)
+
+        inspector = sqlalchemy.inspect(engine)
+        for table in redmill.models.Base.metadata.sorted_tables:
+            self.assertEqual(
+                set(x["name"] for x in inspector.get_columns(table.name)),
+                set(x.name for x in table.columns))
+
+        engine.dispose()
+
+    def test_upgrade_indexes(self):
+        engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        redmill.models.Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text(
+                "DROP INDEX ix_item_parent_id_status_rank"))
+
+        redmill.database.upgrade(engine, redmill.models.Base.metadata)
+
+        inspector = sqlalchemy.inspect(engine)
+        self.assertTrue(
+            "ix_item_parent_id_status_rank" in
+            [x["name"] for x in inspector.get_indexes("item")])
+
+        engine.dispose()
+
+    def test_query_plans(self):
+        engine = sqlalchemy.create_engine("sqlite:///:memory:")
+        redmill.models.Base.metadata.create_all(engine)
+        session = sqlalchemy.orm.sessionmaker(bind=engine)()
+
+        Item = redmill.models.Item
+        item = sqlalchemy.orm.with_polymorphic(Item, Item.sub_types)
+        table = Item.__table__
+
+        queries = [
+            # Page of children and count (get_album)
+            session.query(item)\
+                .filter(Item.parent_id == 1, Item.status.in_(["published"]))\
+                .order_by(Item.rank, Item.id).limit(30).offset(30),
+            session.query(sqlalchemy.func.count(Item.id))\
+                .filter(Item.parent_id == 1, Item.status.in_(["published"])),
+            # Top-level albums (get_toplevel)
+            session.query(redmill.models.Album)\
+                .filter_by(parent_id=None).order_by(redmill.models.Album.rank),
+            # Children of an album (order_children)
+            sqlalchemy.select([table.c.id, table.c.rank])\
+                .where(table.c.parent_id == 1)\
+                .order_by(table.c.rank, table.c.id),
+            # Derivatives of a media (derivative.get_all)
+            session.query(redmill.models.Derivative).filter_by(media_id=1),
+        ]
+
+        for query in queries:
+            statement = getattr(query, "statement", query)
+            sql = str(statement.compile(
+                dialect=engine.dialect,
+                compile_kwargs={"literal_binds": True}))
+            with engine.connect() as connection:
+                plan = [
+                    x[-1] for x in connection.execute(
+                        sqlalchemy.text("EXPLAIN QUERY PLAN {}".format(sql)))]
+
+            for step in plan:
+                # Only index searches, no full scan and no sort
+                self.assertTrue(step.startswith("SEARCH"), (sql, plan))
+                self.assertTrue("TEMP B-TREE" not in step, (sql, plan))
+
+        subtree = redmill.models.item._get_subtree(1, "/1/")
+        album = redmill.models.Album(id=1, path="/1/")
+        queries = [
+            # Descendants of an album (get_descendants, deepest first)
+            album.get_descendants(),
+            # Items of a subtree (delete_tree)
+            sqlalchemy.select([table.c.id]).where(subtree),
+            # Visibility and path of a subtree (_update_visibility,
+            # _update_path)
+            table.update().where(subtree).values(visible=False),
+        ]
+
+        for query in queries:
+            statement = getattr(query, "statement", query)
+            sql = str(statement.compile(
+                dialect=engine.dialect,
+                compile_kwargs={"literal_binds": True}))
+            with engine.connect() as connection:
+                plan = [
+                    x[-1] for x in connection.execute(
+                        sqlalchemy.text("EXPLAIN QUERY PLAN {}".format(sql)))]
+
+            # Index searches, the deepest-first order requires a sort
+            self.assertTrue("ix_item_path" in plan[0], (sql, plan))
+            for step in plan:
+                self.assertTrue(
+                    step.startswith("SEARCH") or
+                    step == "USE TEMP B-TREE FOR ORDER BY", (sql, plan))
+
+        session.close()
+        engine.dispose()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy
+
+import redmill.importer
+import redmill.models
+
+import database_test
+
+class TestImporter(database_test.DatabaseTest):
+    def setUp(self):
+        database_test.DatabaseTest.setUp(self)
+        self.source = tempfile.mkdtemp()
+        self.media_directory = tempfile.mkdtemp()
+
+        image = os.path.join(os.path.dirname(__file__), "image.jpg")
+        for path in ["2019/a.jpg", "2019/Summer/b.jpg", "2020/c.jpg"]:
+            directory = os.path.join(self.source, os.path.dirname(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            shutil.copyfile(image, os.path.join(self.source, path))
+        with open(os.path.join(self.source, "2020", ".hidden"), "w") as fd:
+            fd.write("hidden")
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.media_directory)
+        database_test.DatabaseTest.tearDown(self)
+
+    def test_scan(self):
+        self.assertEqual(
+            redmill.importer.scan(self.source), [
+                {"path": os.path.join("2019", "a.jpg")},
+                {"path": os.path.join("2019", "Summer", "b.jpg")},
+                {"path": os.path.join("2020", "c.jpg")}])
+
+    def test_import(self):
+        progress = []
+        ids = redmill.importer.import_files(
+            self.session, self.media_directory, self.source,
+            redmill.importer.scan(self.source), author=u"Foo", batch_size=2,
+            workers=0, progress=lambda *args: progress.append(args))
+
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(progress, [(2, 3), (3, 3)])
+
+        albums = {
+            x.name: x for x in self.session.query(redmill.models.Album)}
+        self.assertEqual(sorted(albums.keys()), ["2019", "2020", "Summer"])
+        self.assertEqual(albums["2019"].parent_id, None)
+        self.assertEqual(albums["Summer"].parent_id, albums["2019"].id)
+        self.assertEqual(albums["Summer"].path, "/{}/{}/".format(
+            albums["2019"].id, albums["Summer"].id))
+
+        media = [self.session.query(redmill.models.Media).get(x) for x in ids]
+        self.assertEqual(
+            [(x.name, x.parent_id, x.rank) for x in media], [
+                ("a.jpg", albums["2019"].id, 1),
+                ("b.jpg", albums["Summer"].id, 0),
+                ("c.jpg", albums["2020"].id, 0)])
+
+        image = os.path.join(os.path.dirname(__file__), "image.jpg")
+        with open(image, "rb") as fd:
+            content = fd.read()
+        for item in media:
+            self.assertEqual(item.author, u"Foo")
+            self.assertEqual(item.mime_type, "image/jpeg")
+            self.assertEqual(item.size, len(content))
+            self.assertTrue(item.visible)
+            self.assertEqual(
+                item.path, "{}{}/".format(item.parent.path, item.id))
+            with open(os.path.join(
+                    self.media_directory, "{}".format(item.id)), "rb") as fd:
+                self.assertEqual(fd.read(), content)
+
+    def test_import_workers(self):
+        entries = redmill.importer.scan(self.source)
+        ids = redmill.importer.import_files(
+            self.session, self.media_directory, self.source, entries,
+            workers=2)
+
+        hashes = set(
+            x.content_hash for x in self.session.query(redmill.models.Media))
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(hashes), 1)
+
+    def test_import_existing_album(self):
+        album = redmill.models.Album(name=u"2019")
+        self.session.add(album)
+        self.session.commit()
+        album_id = album.id
+
+        entries = [{
+            "path": os.path.join("2019", "a.jpg"), "name": u"Bar",
+            "keywords": [u"baz"]}]
+        ids = redmill.importer.import_files(
+            self.session, self.media_directory, self.source, entries,
+            link=True, workers=0)
+
+        media = self.session.query(redmill.models.Media).get(ids[0])
+        self.assertEqual(media.parent_id, album_id)
+        self.assertEqual(media.name, u"Bar")
+        self.assertEqual(media.keywords, [u"baz"])
+        self.assertEqual(self.session.query(redmill.models.Album).count(), 1)
+
+        destination = os.path.join(self.media_directory, "{}".format(media.id))
+        self.assertTrue(os.path.isfile(destination))
+
+    def test_import_queries(self):
+        album = redmill.models.Album(name=u"2019")
+        self.session.add(album)
+        self.session.commit()
+        album_id, album_path = album.id, album.path
+
+        image = os.path.join(self.source, "2019", "a.jpg")
+        for name in ["b.jpg", "c.jpg"]:
+            shutil.copyfile(image, os.path.join(self.source, "2019", name))
+        entries = [
+            {"path": os.path.join("2019", x)}
+            for x in ["a.jpg", "b.jpg", "c.jpg"]]
+
+        statements = []
+        def count(connection, cursor, statement, parameters, *args):
+            if statement.startswith(
+                    ("UPDATE item", "SELECT item.path", "SELECT item.visible")):
+                statements.append(statement)
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            ids = redmill.importer.import_files(
+                self.session, self.media_directory, self.source, entries,
+                workers=0)
+        finally:
+            sqlalchemy.event.remove(
+                self.engine, "before_cursor_execute", count)
+
+        # No queries of the parent for each media, one update of the paths
+        # per batch
+        self.assertEqual(
+            statements, ["UPDATE item SET path=? WHERE item.id = ?"])
+
+        for id_ in ids:
+            media = self.session.query(redmill.models.Media).get(id_)
+            self.assertEqual(media.parent_id, album_id)
+            self.assertEqual(media.path, "{}{}/".format(album_path, id_))
+            self.assertTrue(media.visible)
+
+    def test_import_invalid(self):
+        with open(os.path.join(self.source, "a.jpg"), "w") as fd:
+            fd.write("foo")
+
+        for entries in [
+                [{"path": os.path.join("..", "a.jpg")}],
+                [{"path": os.path.join("2019", "missing.jpg")}],
+                # Media at the top-level
+                [{"path": os.path.join("2019", "a.jpg")}, {"path": "a.jpg"}]]:
+            self.assertRaises(
+                ValueError, redmill.importer.import_files, self.session,
+                self.media_directory, self.source, entries, workers=0)
+
+        self.assertEqual(self.session.query(redmill.models.Item).count(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
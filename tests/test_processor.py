@@ -17,6 +17,7 @@ import os
 import unittest
 
 import PIL.Image
+import PIL.ImageChops
 
 import redmill.processor
 
@@ -54,5 +55,164 @@ class TestProcessor(unittest.TestCase):
                 "rb").read())
         self.assertEqual(explicit, image)
 
+    def test_transpose(self):
+        transposed = redmill.processor.transpose(self.image, "rotate_90")
+        self.assertEqual(transposed.size, tuple(reversed(self.image.size)))
+
+    def test_plan_no_op(self):
+        size = self.image.size
+        plan = redmill.processor.plan(
+            [
+                ["rotate", {"degrees": 0}],
+                ["crop", {"left": 0, "top": 0, "width": "100%", "height": "100%"}],
+                ["resize", {"width": size[0]}],
+            ], size)
+        self.assertEqual(plan, [])
+
+    def test_plan_crop_before_resize(self):
+        plan = redmill.processor.plan(
+            [
+                ["resize", {"width": "50%", "height": "50%"}],
+                ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}]
+            ], (640, 480))
+        self.assertEqual(
+            plan,
+            [
+                ("crop", {"left": 20, "top": 40, "width": 60, "height": 80}),
+                ("resize", {"width": 30, "height": 40})
+            ])
+
+    def test_plan_resizes(self):
+        plan = redmill.processor.plan(
+            [
+                ["resize", {"width": 320}],
+                ["resize", {"height": "50%"}]
+            ], (640, 480))
+        self.assertEqual(plan, [("resize", {"width": 160, "height": 120})])
+
+    def test_plan_rotations(self):
+        plan = redmill.processor.plan(
+            [["rotate", {"degrees": 90}], ["rotate", {"degrees": 180}]],
+            (640, 480))
+        self.assertEqual(plan, [("transpose", {"method": "rotate_270"})])
+
+        plan = redmill.processor.plan(
+            [["rotate", {"degrees": 90}], ["rotate", {"degrees": -90}]],
+            (640, 480))
+        self.assertEqual(plan, [])
+
+    def test_plan_rotate_then_resize(self):
+        plan = redmill.processor.plan(
+            [["rotate", {"degrees": 90}], ["resize", {"width": 240}]],
+            (640, 480))
+        self.assertEqual(
+            plan,
+            [
+                ("resize", {"width": 320, "height": 240}),
+                ("transpose", {"method": "rotate_90"})
+            ])
+
+    def test_plan_barrier(self):
+        operations = [
+            ["rotate", {"degrees": 45}],
+            ["resize", {"width": 10}], ["resize", {"width": 20}]]
+        plan = redmill.processor.plan(operations, (640, 480))
+        self.assertEqual(plan, [tuple(x) for x in operations])
+
+    def test_plan_outside_crop(self):
+        operations = [
+            ["resize", {"width": 320}],
+            ["crop", {"left": 300, "top": 0, "width": 40, "height": 40}]]
+        plan = redmill.processor.plan(operations, (640, 480))
+        self.assertEqual(
+            plan,
+            [
+                ("resize", {"width": 320, "height": 240}),
+                ("crop", {"left": 300, "top": 0, "width": 40, "height": 40})
+            ])
+
+    def test_apply_planned(self):
+        sequences = [
+            [
+                ["resize", {"width": "50%"}],
+                ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}]
+            ],
+            [
+                ["rotate", {"degrees": 90}],
+                ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}],
+                ["resize", {"width": 15}]
+            ],
+            [
+                ["rotate", {"degrees": 270}],
+                ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}],
+            ],
+            [
+                ["rotate", {"degrees": 180}],
+                ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}],
+            ],
+            [
+                ["crop", {"left": "10%", "top": "10%", "width": "50%", "height": "50%"}],
+                ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}],
+                ["rotate", {"degrees": 12}],
+                ["resize", {"height": 20}]
+            ],
+        ]
+        for operations in sequences:
+            expected = self.image
+            for operation, parameters in operations:
+                expected = getattr(redmill.processor, operation)(
+                    expected, **parameters)
+            result = redmill.processor.apply(operations, self.image)
+
+            self.assertEqual(result.size, expected.size)
+            # Rotations by multiples of 90 degrees are exact
+            if (
+                    operations[0][0] == "rotate" and
+                    all(x[0] == "crop" for x in operations[1:])):
+                self.assertEqual(
+                    list(result.getdata()), list(expected.getdata()))
+
+    def test_apply_quality(self):
+        filename = os.path.join(os.path.dirname(__file__), "image.jpg")
+        operations = [
+            ["crop", {"left": 0, "top": 0, "width": "50%", "height": "50%"}],
+            ["resize", {"width": 40}]]
+
+        reference = redmill.processor.apply(operations, self.image, "high")
+
+        for quality in ["low", "normal"]:
+            image = PIL.Image.open(filename)
+            size = image.size
+            result = redmill.processor.apply(operations, image, quality)
+
+            # Decoded at a lower resolution
+            self.assertTrue(image.size[0] < size[0])
+
+            self.assertEqual(result.size, reference.size)
+            difference = PIL.ImageChops.difference(
+                result.convert("L"), reference.convert("L"))
+            histogram = difference.histogram()
+            mean = sum(i*x for i, x in enumerate(histogram))/float(
+                sum(histogram))
+            self.assertTrue(mean < 10)
+
+    def test_apply_quality_no_downscale(self):
+        filename = os.path.join(os.path.dirname(__file__), "image.jpg")
+        operations = [["resize", {"width": "75%"}]]
+
+        image = PIL.Image.open(filename)
+        size = image.size
+        result = redmill.processor.apply(operations, image, "low")
+        self.assertEqual(image.size, size)
+
+    def test_apply_quality_modes(self):
+        # Image.reduce does not support these modes
+        operations = [["resize", {"width": 40}]]
+        for mode in ["P", "1", "I;16"]:
+            image = self.image.convert("L" if mode == "I;16" else "RGB")
+            image = image.convert(mode)
+            result = redmill.processor.apply(operations, image, "normal")
+            self.assertEqual(result.size[0], 40)
+
 if __name__ == "__main__":
     unittest.main()
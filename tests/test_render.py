@@ -0,0 +1,95 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import PIL.Image
+
+import redmill.render
+
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(os.path.dirname(__file__), "image.jpg")
+        self.operations = [
+            ["crop", {"left": 10, "top": 20, "width": 30, "height": 40}]]
+
+    def _check(self, data):
+        image = PIL.Image.open(io.BytesIO(data))
+        self.assertEqual(image.format, "PNG")
+        self.assertEqual(image.size, (30, 40))
+
+    def test_render(self):
+        self._check(redmill.render.render(self.filename, self.operations))
+
+    def test_local_executor(self):
+        executor = redmill.render.LocalExecutor()
+        self._check(executor.render(self.filename, self.operations))
+
+    def test_process_executor(self):
+        executor = redmill.render.ProcessExecutor(2)
+        try:
+            self._check(executor.render(self.filename, self.operations))
+            self._check(
+                executor.render(self.filename, self.operations, blocking=True))
+        finally:
+            executor.close()
+
+    def test_process_executor_busy(self):
+        executor = redmill.render.ProcessExecutor(1, 1)
+        try:
+            executor._jobs.acquire()
+            self.assertRaises(
+                redmill.render.Busy,
+                executor.render, self.filename, self.operations)
+            executor._jobs.release()
+            self._check(executor.render(self.filename, self.operations))
+        finally:
+            executor.close()
+
+    def test_process_executor_timeout(self):
+        # Reading from a FIFO blocks the worker until data is written
+        directory = tempfile.mkdtemp()
+        fifo = os.path.join(directory, "fifo")
+        os.mkfifo(fifo)
+
+        executor = redmill.render.ProcessExecutor(1, 1, 0.5)
+        try:
+            self.assertRaises(
+                redmill.render.Timeout,
+                executor.render, fifo, self.operations)
+
+            # The job is still running and keeps its slot
+            self.assertRaises(
+                redmill.render.Busy,
+                executor.render, self.filename, self.operations)
+
+            with open(fifo, "wb") as fd:
+                with open(self.filename, "rb") as source:
+                    fd.write(source.read())
+
+            # The slot is released when the job finishes
+            executor.timeout = None
+            self._check(
+                executor.render(self.filename, self.operations, blocking=True))
+        finally:
+            executor.close()
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    unittest.main()
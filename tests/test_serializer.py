@@ -0,0 +1,65 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import unittest
+
+import flask
+
+import redmill
+import redmill.serializer
+
+import flask_test
+
+class TestSerializer(flask_test.FlaskTest):
+    def tearDown(self):
+        redmill.controller.app.config["fast_json"] = True
+        flask_test.FlaskTest.tearDown(self)
+
+    def test_url_template(self):
+        template = redmill.serializer.get_url_template("album.get", "id_")
+        self.assertEqual(template.format(id_=42), flask.url_for("album.get", id_=42))
+
+        template = redmill.serializer.get_url_template(
+            "derivative.get", "id_", media_id=12)
+        self.assertEqual(
+            template.format(id_=3),
+            flask.url_for("derivative.get", media_id=12, id_=3))
+
+    def test_item_urls(self):
+        urls = redmill.serializer.get_item_urls(
+            [("album", 1), ("media", 2, 0), ("album", 3)])
+        self.assertEqual(
+            urls, [
+                flask.url_for("album.get", id_=1),
+                flask.url_for("media.get", id_=2),
+                flask.url_for("album.get", id_=3)])
+
+    def test_dumps(self):
+        album = self._insert_album(u"Röôt album")
+        self._insert_album(u"Child", album.id)
+        album = self.session.query(redmill.models.Album).get(album.id)
+
+        redmill.controller.app.config["fast_json"] = True
+        fast = json.loads(redmill.serializer.dumps(album))
+        redmill.controller.app.config["fast_json"] = False
+        slow = json.loads(redmill.serializer.dumps(album))
+
+        self.assertEqual(fast, slow)
+        self.assertEqual(fast["name"], u"Röôt album")
+        self.assertEqual(len(fast["children"]), 1)
+
+if __name__ == "__main__":
+    unittest.main()
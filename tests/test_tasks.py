@@ -0,0 +1,63 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import unittest
+
+import redmill.tasks
+
+class TestLocalQueue(unittest.TestCase):
+    def test_submit(self):
+        queue = redmill.tasks.LocalQueue()
+        result = []
+        queue.submit(result.append, 1)
+        self.assertEqual(result, [1])
+        self.assertEqual(queue.depth, 0)
+
+    def test_error(self):
+        queue = redmill.tasks.LocalQueue()
+        queue.submit(lambda: 1/0)
+
+class TestThreadQueue(unittest.TestCase):
+    def test_submit(self):
+        queue = redmill.tasks.ThreadQueue(2)
+        result = []
+        for index in range(10):
+            queue.submit(result.append, index)
+        queue.join()
+
+        self.assertEqual(sorted(result), list(range(10)))
+        self.assertEqual(queue.depth, 0)
+
+    def test_depth(self):
+        queue = redmill.tasks.ThreadQueue()
+        event = threading.Event()
+        queue.submit(event.wait)
+        queue.submit(lambda: None)
+        self.assertEqual(queue.depth, 2)
+        event.set()
+        queue.join()
+        self.assertEqual(queue.depth, 0)
+
+    def test_error(self):
+        queue = redmill.tasks.ThreadQueue()
+        result = []
+        queue.submit(lambda: 1/0)
+        queue.submit(result.append, 1)
+        queue.join()
+        self.assertEqual(result, [1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import redmill.database
+import redmill.upload
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_copy(self):
+        filename = os.path.join(os.path.dirname(__file__), "image.jpg")
+        content = open(filename, "rb").read()
+
+        upload = redmill.upload.Upload(self.directory, 1000)
+        upload.copy(io.BytesIO(content))
+
+        self.assertEqual(
+            upload.info, redmill.database.get_content_info(filename))
+
+        destination = os.path.join(self.directory, "foo")
+        upload.commit(destination)
+        self.assertEqual(os.listdir(self.directory), ["foo"])
+        self.assertEqual(open(destination, "rb").read(), content)
+
+    def test_existing_file(self):
+        filename = os.path.join(os.path.dirname(__file__), "image.jpg")
+        content = open(filename, "rb").read()
+
+        path = os.path.join(self.directory, ".upload-foo")
+        with open(path, "wb") as fd:
+            fd.write(content)
+
+        upload = redmill.upload.Upload(self.directory, 1000, path)
+        self.assertEqual(
+            upload.info, redmill.database.get_content_info(filename))
+
+        upload.commit(os.path.join(self.directory, "1"))
+        self.assertEqual(os.listdir(self.directory), ["1"])
+
+    def test_replace(self):
+        destination = os.path.join(self.directory, "foo")
+        with open(destination, "wb") as fd:
+            fd.write(b"foo")
+
+        upload = redmill.upload.Upload(self.directory)
+        upload.write(b"bar")
+        upload.commit(destination)
+
+        self.assertEqual(os.listdir(self.directory), ["foo"])
+        self.assertEqual(open(destination, "rb").read(), b"bar")
+
+    def test_abort(self):
+        upload = redmill.upload.Upload(self.directory)
+        upload.write(b"foo")
+        upload.abort()
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import json
 import os
 import sys
@@ -22,6 +23,7 @@ import unittest
 
 import bs4
 import flask
+import sqlalchemy
 
 import redmill
 import redmill.models
@@ -118,6 +120,75 @@ class TestAlbum(flask_test.FlaskTest):
         self._assert_album_equal(
             {"name": u"Röôt album", "parent_id": None}, data)
 
+    def test_get_album_embed(self):
+        album = self._insert_album(u"Röôt album")
+        sub_album = self._insert_album(u"Süb âlbum", album.id)
+        grandchild = self._insert_album(u"Grândchild", sub_album.id)
+        media = self._insert_media(u"Foo", u"Bar", album.id)
+        derivative = self._insert_derivative(media, [["resize", {"width": 10}]])
+
+        status, _, data = self._get_response(
+            "get", flask.url_for("album.get", id_=album.id, embed="children"),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 200)
+        self._assert_album_equal({"name": u"Röôt album"}, data)
+        self.assertEqual(len(data["children"]), 2)
+
+        self._assert_album_equal(
+            {
+                "id": sub_album.id, "name": u"Süb âlbum",
+                "url": flask.url_for("album.get", id_=sub_album.id),
+                "children": [flask.url_for("album.get", id_=grandchild.id)]
+            },
+            data["children"][0])
+        self._assert_media_equal(
+            {
+                "id": media.id, "name": u"Foo", "author": u"Bar",
+                "url": flask.url_for("media.get", id_=media.id),
+                "derivatives": [
+                    flask.url_for(
+                        "derivative.get", media_id=media.id, id_=derivative.id)]
+            },
+            data["children"][1])
+
+    def test_get_album_fields(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(u"Foo", u"Bar", album.id)
+
+        status, _, data = self._get_response(
+            "get", flask.url_for(
+                "album.get", id_=album.id, embed="children",
+                fields="name,derivatives"),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            data["children"], [{
+                "id": media.id, "type": "Media", "name": u"Foo",
+                "url": flask.url_for("media.get", id_=media.id),
+                "derivatives": []}])
+
+        status, _, _ = self._get_response(
+            "get", flask.url_for("album.get", id_=album.id, embed="foo"),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 400)
+
+    def test_get_roots_embed(self):
+        album = self._insert_album(u"Röôt album")
+
+        status, _, data = self._get_response(
+            "get", flask.url_for("album.get_roots", embed="children"),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data), 1)
+        self._assert_album_equal(
+            {
+                "id": album.id, "name": u"Röôt album",
+                "url": flask.url_for("album.get", id_=album.id)},
+            data[0])
+
     def test_get_album_html(self):
         album = self._insert_album(u"Röôt album")
         sub_album = self._insert_album(u"Süb âlbum", album.id)
@@ -409,6 +480,212 @@ class TestAlbum(flask_test.FlaskTest):
             "get", flask.url_for("media.get", id_=media_id_))
         self.assertEqual(status, 404)
 
+    def test_delete_tree(self):
+        album = self._insert_album(u"Röôt album")
+        sub_album = self._insert_album(u"Süb âlbum", album.id)
+        other_album = self._insert_album(u"Öther album")
+        media = [
+            self._insert_media(
+                u"Foo {}".format(index), u"Bar", parent_id, content=b"foo")
+            for index, parent_id in enumerate(
+                [album.id, sub_album.id, sub_album.id, other_album.id])]
+        derivatives = [
+            self._insert_derivative(x, [["resize", {"width": 10}]])
+            for x in media]
+
+        cache = redmill.views.get_cache()
+        for item in media:
+            cache.put(item.id, 1, [], 0, b"foo")
+
+        ids = [x.id for x in media]
+        status, _, _ = self._get_response(
+            "delete", flask.url_for("album.delete", id_=album.id))
+        self.assertEqual(status, 204)
+
+        self.session.expire_all()
+        self.assertEqual(
+            [x.id for x in self.session.query(redmill.models.Item)],
+            [other_album.id, ids[-1]])
+        self.assertEqual(
+            [x.media_id for x in self.session.query(redmill.models.Derivative)],
+            [ids[-1]])
+
+        directory = redmill.controller.app.config["media_directory"]
+        for id_ in ids[:-1]:
+            self.assertFalse(os.path.isfile(os.path.join(directory, str(id_))))
+            self.assertEqual(cache.get(id_, 1, [], 0), None)
+        self.assertTrue(os.path.isfile(os.path.join(directory, str(ids[-1]))))
+        self.assertEqual(cache.get(ids[-1], 1, [], 0), b"foo")
+
+    def test_delete_tree_reused_id(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=b"foo")
+        media_id = media.id
+        cache = redmill.views.get_cache()
+        cache.put(media_id, 1, [], 0, b"foo")
+
+        # Keep the removal of the files in the queue
+        class Queue(object):
+            def __init__(self):
+                self.tasks = []
+            def submit(self, function, *args, **kwargs):
+                self.tasks.append((function, args, kwargs))
+        queue = Queue()
+        redmill.controller.app.config["render_queue"] = queue
+
+        status, _, _ = self._get_response(
+            "delete", flask.url_for("album.delete", id_=album.id))
+        self.assertEqual(status, 204)
+        self.assertEqual(len(queue.tasks), 1)
+
+        # SQLite reuses the ids of the deleted album and media
+        other_album = self._insert_album(u"Öther album")
+        other = self._insert_media(
+            u"Other", u"Bar", other_album.id, content=b"bar")
+        self.assertEqual(other.id, media_id)
+        cache.put(media_id, 1, [], 0, b"bar")
+
+        for function, args, kwargs in queue.tasks:
+            function(*args, **kwargs)
+
+        directory = redmill.controller.app.config["media_directory"]
+        with open(os.path.join(directory, str(media_id)), "rb") as fd:
+            self.assertEqual(fd.read(), b"bar")
+        self.assertEqual(cache.get(media_id, 1, [], 0), b"bar")
+        self.assertEqual(
+            [x for x in os.listdir(directory) if x.startswith(".deleted-")],
+            [])
+
+    def test_delete_tree_without_path(self):
+        album = self._insert_album(u"Röôt album")
+        sub_album = self._insert_album(u"Süb âlbum", album.id)
+        media = self._insert_media(u"Foo", u"Bar", sub_album.id)
+
+        self.session.query(redmill.models.Item).update({"path": None})
+        self.session.commit()
+
+        status, _, _ = self._get_response(
+            "delete", flask.url_for("album.delete", id_=album.id))
+        self.assertEqual(status, 204)
+
+        self.session.expire_all()
+        self.assertEqual(self.session.query(redmill.models.Item).count(), 0)
+
+    def test_get_album_queries(self):
+        def count_queries(url, accept):
+            statements = []
+            def count(*args):
+                statements.append(args)
+            sqlalchemy.event.listen(self.engine, "before_cursor_execute", count)
+            try:
+                status, _, _ = self._get_response(
+                    "get", url, headers={"Accept": accept})
+            finally:
+                sqlalchemy.event.remove(
+                    self.engine, "before_cursor_execute", count)
+            self.assertEqual(status, 200)
+            return len(statements)
+
+        small = self._insert_album(u"Small")
+        self._insert_album(u"Child", small.id)
+
+        large = self._insert_album(u"Large")
+        parent_id = large.id
+        for depth in range(5):
+            for index in range(3):
+                album = self._insert_album(
+                    u"Album {}-{}".format(depth, index), parent_id)
+                self._insert_media(u"Media", u"Author", album.id)
+            parent_id = album.id
+
+        # The number of queries does not depend on the size of the subtree
+        redmill.views.get_tree_snapshot()
+        for accept in ["application/json", "text/html"]:
+            self.assertEqual(
+                count_queries(flask.url_for("album.get", id_=large.id), accept),
+                count_queries(flask.url_for("album.get", id_=small.id), accept))
+
+        # Embedding the children does not depend on their number either
+        self._insert_media(u"Media", u"Author", small.id)
+        self._insert_media(u"Media", u"Author", large.id)
+        self.assertEqual(
+            count_queries(
+                flask.url_for("album.get", id_=large.id, embed="children"),
+                "application/json"),
+            count_queries(
+                flask.url_for("album.get", id_=small.id, embed="children"),
+                "application/json"))
+
+    def test_tree(self):
+        root = self._insert_album(u"Röôt album")
+
+        status, _, data = self._get_response(
+            "get", flask.url_for("album.get", id_=root.id),
+            headers={"Accept": "text/html"})
+        document = bs4.BeautifulSoup(data, "html.parser")
+        self.assertEqual(
+            [x["data-rm-id"] for x in document.select(".tree span")],
+            ["", str(root.id)])
+
+        # Served from the cached snapshot
+        snapshot = redmill.views.get_tree_snapshot()
+        self.assertTrue(snapshot is redmill.views.get_tree_snapshot())
+
+        # Modified outside of the views (e.g. by another process)
+        other = redmill.models.Album(name=u"Other", parent_id=root.id)
+        self.session.add(other)
+        self.session.commit()
+        snapshot = redmill.views.get_tree_snapshot()
+        self.assertEqual(
+            snapshot, {
+                None: [(root.id, u"Röôt album")],
+                root.id: [(other.id, u"Other")]})
+
+        # Creating an album through the API invalidates the snapshot
+        status, _, album = self._get_response(
+            "post", flask.url_for("album.post"),
+            data=json.dumps({"name": u"Süb âlbum", "parent_id": root.id}),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 201)
+
+        status, _, data = self._get_response(
+            "get", flask.url_for("album.get", id_=album["id"]),
+            headers={"Accept": "text/html"})
+        document = bs4.BeautifulSoup(data, "html.parser")
+        spans = document.select(".tree span")
+        self.assertEqual(len(spans), 4)
+        self.assertEqual(
+            [x.get("disabled") for x in spans],
+            [None, None, None, "disabled"])
+
+    def test_shared_tree(self):
+        class Cache(dict):
+            def set(self, key, value):
+                self[key] = value
+            def delete(self, key):
+                self.pop(key, None)
+
+        cache = Cache()
+        redmill.controller.app.config["tree_cache"] = cache
+        try:
+            root = self._insert_album(u"Röôt album")
+            self.assertEqual(
+                redmill.views.get_tree_snapshot(),
+                {None: [(root.id, u"Röôt album")]})
+            generation, _ = cache["redmill.tree.snapshot"]
+
+            # Snapshot built by another process
+            redmill.views.invalidate_tree()
+            cache["redmill.tree.snapshot"] = (generation, {})
+            self.assertEqual(redmill.views.get_tree_snapshot(), {})
+
+            # Outdated by a modification
+            self._insert_album(u"Other")
+            self.assertEqual(len(redmill.views.get_tree_snapshot()[None]), 2)
+            self.assertTrue(cache["redmill.tree.snapshot"][0] > generation)
+        finally:
+            redmill.controller.app.config["tree_cache"] = None
+
     def test_delete_non_existing_album(self):
         status, _, data = self._get_response(
             "delete", flask.url_for("album.delete", id_=12345),
@@ -671,6 +948,131 @@ class TestAlbum(flask_test.FlaskTest):
         self.assertEqual(count, 4)
         self.assertEqual(set(x.id for x in albums), seen_albums)
 
+    def test_album_pages(self):
+        root = self._insert_album(u"Root")
+        children = []
+        for index in range(20):
+            if index%2 == 0:
+                child = self._insert_album(u"Album {}".format(index), root.id)
+            else:
+                child = self._insert_media(
+                    u"Media {}".format(index), u"Author", root.id)
+            child.rank = index
+            children.append(child)
+        for child in children[::5]:
+            child.status = "archived"
+        self.session.commit()
+
+        published = [x.id for x in children if x.status == "published"]
+
+        page = flask.url_for("album.get", id_=root.id, per_page=5)
+        seen = []
+        while page:
+            status, headers, data = self._get_response(
+                "get", page, headers={"Accept": "application/json"})
+            self.assertEqual(status, 200)
+            self.assertTrue(len(data["children"]) <= 5)
+            seen.extend(
+                int(url.split("/")[-1]) for url in data["children"])
+
+            links = self._parse_links(headers["Link"]) if headers.get("Link") else []
+            links = {parameters["rel"]: url for url, parameters in links}
+            page = links.get("next")
+            if page:
+                self.assertTrue(page.startswith(
+                    flask.url_for("album.get", id_=root.id)))
+
+        # 16 published children fit exactly in 4 pages
+        self.assertEqual(seen, published)
+
+        status, _, _ = self._get_response(
+            "get", flask.url_for("album.get", id_=root.id, page=5, per_page=4),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 400)
+
+        status, _, data = self._get_response(
+            "get",
+            flask.url_for(
+                "album.get", id_=root.id, children="published|archived",
+                page=4, per_page=5),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data["children"]), 5)
+
+    def test_cursor_pages(self):
+        albums = [
+            self._insert_album(u"Röôt album {}".format(index))
+            for index in range(19)
+        ]
+        for index, album in enumerate(albums):
+            album.rank = index//2
+        self.session.commit()
+
+        def walk(page, rel):
+            ids = []
+            while page:
+                status, headers, data = self._get_response(
+                    "get", page, headers={"Accept": "application/json"})
+                self.assertEqual(status, 200)
+                self.assertTrue(len(data) <= 5)
+                ids.append([int(url.split("/")[-1]) for url in data])
+
+                links = self._parse_links(headers["Link"]) if headers.get("Link") else []
+                links = {parameters["rel"]: url for url, parameters in links}
+                page = links.get(rel)
+            return ids, links
+
+        ids, links = walk(
+            flask.url_for("album.get_roots", cursor="", per_page=5), "next")
+        self.assertEqual([len(x) for x in ids], [5, 5, 5, 4])
+        self.assertEqual(sum(ids, []), [x.id for x in albums])
+        self.assertTrue("first" in links)
+
+        previous_ids, links = walk(links["previous"], "previous")
+        self.assertEqual(previous_ids, ids[-2::-1])
+        self.assertTrue("first" not in links)
+        self.assertTrue("next" in links)
+
+    def test_cursor_concurrent_modification(self):
+        albums = [
+            self._insert_album(u"Röôt album {}".format(index))
+            for index in range(10)
+        ]
+        for index, album in enumerate(albums):
+            album.rank = index
+        self.session.commit()
+
+        status, headers, data = self._get_response(
+            "get", flask.url_for("album.get_roots", cursor="", per_page=5),
+            headers={"Accept": "application/json"})
+        links = {
+            parameters["rel"]: url
+            for url, parameters in self._parse_links(headers["Link"])}
+
+        # Insert an item in the first page: the next page must not shift
+        album = self._insert_album(u"New album")
+        album.rank = 0
+        self.session.commit()
+
+        status, headers, data = self._get_response(
+            "get", links["next"], headers={"Accept": "application/json"})
+        self.assertEqual(
+            [int(url.split("/")[-1]) for url in data],
+            [x.id for x in albums[5:]])
+
+    def test_invalid_cursor(self):
+        # Tampered ranks and ids
+        tampered = [
+            base64.urlsafe_b64encode(json.dumps(x).encode()).decode()
+            for x in [
+                ["next", [1], 1], ["next", None, 1], ["previous", "x", 1],
+                ["next", True, 1], ["next", 0, 1.5]]]
+        for cursor in ["foo", "WyJmb28iLCAwLCAxXQ=="]+tampered:
+            status, _, _ = self._get_response(
+                "get", flask.url_for("album.get_roots", cursor=cursor),
+                headers={"Accept": "application/json"})
+            self.assertEqual(status, 400)
+
     def test_order_children_non_toplevel(self):
         root = self._insert_album(u"Root")
         for index in range(0,5):
@@ -742,6 +1144,64 @@ class TestAlbum(flask_test.FlaskTest):
 
         self.assertEqual(status, 400)
 
+    def test_order_children_move(self):
+        root = self._insert_album(u"Root")
+        children = [
+            self._insert_album(u"Album {}".format(1+index), root.id).id
+            for index in range(0,5)]
+
+        def move(data):
+            status, _, _ = self._get_response(
+                "post", flask.url_for("album.order_children", id_=root.id),
+                data=json.dumps(data), headers={"Accept": "application/json"})
+            self.session.expire_all()
+            return status, [x.id for x in root.children]
+
+        status, order = move({"id": children[3], "before": children[1]})
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            order, [children[x] for x in [0, 3, 1, 2, 4]])
+
+        status, order = move({"id": children[0], "before": None})
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            order, [children[x] for x in [3, 1, 2, 4, 0]])
+
+        for data in [
+                {"id": root.id, "before": None},
+                {"id": children[0], "before": root.id},
+                {"id": children[0], "before": children[0]},
+                {"before": children[0]},
+                {"id": [children[0]], "before": None},
+                {"id": children[0], "before": {"id": children[1]}}]:
+            status, _ = move(data)
+            self.assertEqual(status, 400)
+
+    def test_order_children_move_queries(self):
+        root = self._insert_album(u"Root")
+        children = [
+            self._insert_media(u"Media {}".format(index), u"Bar", root.id).id
+            for index in range(0, 10)]
+
+        statements = []
+        def count(connection, cursor, statement, parameters, *args):
+            if statement.startswith("UPDATE item"):
+                statements.append(parameters)
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            status, _, _ = self._get_response(
+                "post", flask.url_for("album.order_children", id_=root.id),
+                data=json.dumps({"id": children[4], "before": children[2]}),
+                headers={"Accept": "application/json"})
+        finally:
+            sqlalchemy.event.remove(
+                self.engine, "before_cursor_execute", count)
+        self.assertEqual(status, 200)
+
+        # New items are placed at the end: only the moved range is renumbered
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(len(statements[0]), 3)
+
     def test_order_children_wrong_type(self):
         root = self._insert_album(u"Root")
         for index in range(0,5):
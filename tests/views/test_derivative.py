@@ -15,11 +15,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import json
 import os
 import sys
 import unittest
 
+import PIL.Image
+
 import redmill
 import redmill.views
 
@@ -73,6 +76,27 @@ class TestDerivative(flask_test.FlaskTest):
             {"media_id": media.id, "operations": derivative2.operations},
             data2)
 
+    def test_get_many(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(u"Foo", u"Bar", album.id)
+        derivative1 = self._insert_derivative(media, [self.crop])
+        derivative2 = self._insert_derivative(
+            media, [["resize", {"width": 10}]])
+
+        status, _, data = self._get_response(
+            "get", "/media/{}/derivatives?ids={},{},{}".format(
+                media.id, derivative2.id, 12345, derivative1.id),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data), 2)
+        self._assert_derivative_equal(
+            {"id": derivative2.id, "operations": derivative2.operations},
+            data[0])
+        self._assert_derivative_equal(
+            {"id": derivative1.id, "operations": derivative1.operations},
+            data[1])
+
     def test_get_html(self):
         album = self._insert_album(u"Röôt album")
         media = self._insert_media(u"Foo", u"Bar", album.id)
@@ -160,6 +184,154 @@ class TestDerivative(flask_test.FlaskTest):
         self.assertEqual(status, 200)
         self.assertEqual(headers["Content-Type"], "image/png")
 
+    def test_get_content_palette(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        data = io.BytesIO()
+        PIL.Image.open(filename).convert("P").save(data, format="GIF")
+        media = self._insert_media(
+            u"Foo", u"Bar", album.id, content=data.getvalue())
+
+        derivative = self._insert_derivative(
+            media, [["resize", {"width": 100}]])
+
+        status, _, data = self._get_response(
+            "get",
+            "/media/{}/derivative/{}/content".format(media.id, derivative.id))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(PIL.Image.open(io.BytesIO(data)).size[0], 100)
+
+    def test_get_content_cached(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=content)
+
+        derivative = self._insert_derivative(media, [self.crop])
+        url = "/media/{}/derivative/{}/content".format(media.id, derivative.id)
+
+        _, _, data = self._get_response("get", url)
+
+        cache = redmill.views.get_cache()
+        mtime = os.path.getmtime(os.path.join(
+            redmill.controller.app.config["media_directory"],
+            "{}".format(media.id)))
+        self.assertEqual(
+            cache.get(media.id, derivative.id, derivative.operations, mtime),
+            data)
+
+        # Cached data must be served
+        cache.put(
+            media.id, derivative.id, derivative.operations, mtime, b"cached")
+        _, _, cached_data = self._get_response("get", url)
+        self.assertEqual(cached_data, b"cached")
+
+    def test_get_content_invalidated(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=content)
+
+        derivative = self._insert_derivative(media, [self.crop])
+        url = "/media/{}/derivative/{}/content".format(media.id, derivative.id)
+
+        self._get_response("get", url)
+
+        cache_directory = os.path.join(
+            redmill.controller.app.config["media_directory"], "cache",
+            "{}".format(media.id))
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+
+        status, _, _ = self._get_response(
+            "delete", "/media/{}/derivative/{}".format(media.id, derivative.id))
+        self.assertEqual(status, 204)
+
+        self.assertEqual(len(os.listdir(cache_directory)), 0)
+
+    def test_get_content_conditional(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=content)
+
+        derivative = self._insert_derivative(media, [self.crop])
+        url = "/media/{}/derivative/{}/content".format(media.id, derivative.id)
+
+        status, headers, _ = self._get_response("get", url)
+        self.assertEqual(status, 200)
+        self.assertTrue("ETag" in headers)
+        self.assertTrue("Last-Modified" in headers)
+        self.assertEqual(headers["Cache-Control"], "no-cache")
+
+        status, _, data = self._get_response(
+            "get", url, headers={"If-None-Match": headers["ETag"]})
+        self.assertEqual(status, 304)
+        self.assertEqual(data, b"")
+
+        status, _, _ = self._get_response(
+            "get", url, headers={"If-None-Match": "\"foo\""})
+        self.assertEqual(status, 200)
+
+        status, _, _ = self._get_response(
+            "get", url, headers={"If-Modified-Since": headers["Last-Modified"]})
+        self.assertEqual(status, 304)
+
+        # Modifying the operations changes the ETag
+        status, _, _ = self._get_response(
+            "patch", "/media/{}/derivative/{}".format(media.id, derivative.id),
+            data=json.dumps({"operations": [["resize", {"width": 10}]]}))
+        self.assertEqual(status, 200)
+
+        status, _, _ = self._get_response(
+            "get", url, headers={"If-None-Match": headers["ETag"]})
+        self.assertEqual(status, 200)
+
+    def test_add_prerender(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=content)
+
+        status, _, data = self._get_response(
+            "post", "/media/{}/derivative/".format(media.id),
+            data=json.dumps({"operations": [self.crop]}),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 201)
+        self.assertTrue(data["warm"])
+
+    def test_warm(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=content)
+        derivative = self._insert_derivative(media, [self.crop])
+        url = "/media/{}/derivative/{}".format(media.id, derivative.id)
+
+        _, _, data = self._get_response(
+            "get", url, headers={"Accept": "application/json"})
+        self.assertFalse(data["warm"])
+
+        self._get_response("get", "{}/content".format(url))
+
+        _, _, data = self._get_response(
+            "get", url, headers={"Accept": "application/json"})
+        self.assertTrue(data["warm"])
+
+    def test_render_queue(self):
+        status, _, data = self._get_response(
+            "get", "/render_queue", headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, {"depth": 0})
+
     def test_patch(self):
         pass
 
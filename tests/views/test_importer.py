@@ -0,0 +1,111 @@
+# encoding: utf-8
+
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import redmill
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import flask_test
+
+class TestImporter(flask_test.FlaskTest):
+    def setUp(self):
+        flask_test.FlaskTest.setUp(self)
+        redmill.controller.app.config["authenticator"] = lambda x: True
+        redmill.controller.app.debug = True
+
+        self.source = tempfile.mkdtemp()
+        redmill.controller.app.config["import_directory"] = self.source
+        os.makedirs(os.path.join(self.source, "album"))
+        shutil.copyfile(
+            os.path.join(os.path.dirname(__file__), "..", "image.jpg"),
+            os.path.join(self.source, "album", "image.jpg"))
+
+    def tearDown(self):
+        redmill.controller.app.config["import_directory"] = None
+        shutil.rmtree(self.source)
+        flask_test.FlaskTest.tearDown(self)
+
+    def test_import(self):
+        album = self._insert_album(u"Röôt album")
+
+        status, _, data = self._get_response(
+            "post", "/import", data=json.dumps({
+                "parent_id": album.id, "author": u"Foo",
+                "items": [{"path": "album/image.jpg", "name": u"Bar"}]}),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 201)
+        self.assertEqual(len(data), 1)
+
+        status, _, media = self._get_response(
+            "get", data[0], headers={"Accept": "application/json"})
+        self._assert_media_equal(
+            {"name": u"Bar", "author": u"Foo", "mime_type": "image/jpeg"},
+            media)
+
+        status, _, sub_album = self._get_response(
+            "get", "/albums/{}".format(media["parent_id"]),
+            headers={"Accept": "application/json"})
+        self._assert_album_equal(
+            {"name": u"album", "parent_id": album.id, "children": [data[0]]},
+            sub_album)
+
+    def test_import_invalid(self):
+        for items in [[{"name": u"Bar"}], [{"path": "../image.jpg"}], None]:
+            status, _, _ = self._get_response(
+                "post", "/import", data=json.dumps({"items": items}),
+                headers={"Accept": "application/json"})
+            self.assertEqual(status, 400)
+
+        path = "album/image.jpg"
+        for data in [
+                {"items": [{"path": 1}]},
+                {"items": [{"path": path, "name": 1}]},
+                {"items": [{"path": path, "author": None}]},
+                {"items": [{"path": path, "keywords": u"foo"}]},
+                {"items": [{"path": path, "keywords": [1]}]},
+                {"items": [{"path": path}], "parent_id": u"1"},
+                {"items": [{"path": path}], "parent_id": True},
+                {"items": [{"path": path}], "author": [u"foo"]}]:
+            status, _, _ = self._get_response(
+                "post", "/import", data=json.dumps(data),
+                headers={"Accept": "application/json"})
+            self.assertEqual(status, 400, data)
+
+        status, _, _ = self._get_response(
+            "post", "/import", data=json.dumps({
+                "parent_id": 12345, "items": [{"path": "album/image.jpg"}]}),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 404)
+
+    def test_import_disabled(self):
+        redmill.controller.app.config["import_directory"] = None
+
+        status, _, _ = self._get_response(
+            "post", "/import",
+            data=json.dumps({"items": [{"path": "album/image.jpg"}]}),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 404)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,12 +16,17 @@
 # along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import hashlib
+import io
 import json
 import os
 import re
 import sys
 import unittest
 
+import PIL.Image
+import sqlalchemy
+
 import redmill
 import redmill.views
 
@@ -116,6 +121,63 @@ class TestMedia(flask_test.FlaskTest):
 
         self.assertEqual(status, 404)
 
+    def test_get_many(self):
+        album = self._insert_album(u"Röôt album")
+        media1 = self._insert_media(u"Foo", u"Bar", album.id)
+        media2 = self._insert_media(u"Baz", u"Bar", album.id)
+        media3 = self._insert_media(u"Hidden", u"Bar", album.id)
+
+        media3.status = "archived"
+        self.session.commit()
+
+        redmill.controller.app.config["authenticator"] = lambda x: False
+
+        status, _, data = self._get_response(
+            "get", "/media/?ids={},{},{},{}".format(
+                media2.id, media1.id, media3.id, 12345),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data), 2)
+        self._assert_media_equal({"id": media2.id, "name": u"Baz"}, data[0])
+        self._assert_media_equal({"id": media1.id, "name": u"Foo"}, data[1])
+
+    def test_get_many_invalid(self):
+        for ids in ["", "1,foo", ",".join(str(x) for x in range(1000))]:
+            status, _, _ = self._get_response(
+                "get", "/media/?ids={}".format(ids),
+                headers={"Accept": "application/json"})
+            self.assertEqual(status, 400)
+
+        status, _, _ = self._get_response(
+            "get", "/media/", headers={"Accept": "application/json"})
+        self.assertEqual(status, 400)
+
+    def test_get_many_queries(self):
+        album = self._insert_album(u"Röôt album")
+        ids = [
+            self._insert_media(u"Foo", u"Bar", album.id).id for _ in range(10)]
+
+        redmill.controller.app.config["authenticator"] = lambda x: False
+
+        def count_queries(ids):
+            statements = []
+            def count(*args):
+                statements.append(args)
+            sqlalchemy.event.listen(self.engine, "before_cursor_execute", count)
+            try:
+                status, _, data = self._get_response(
+                    "get", "/media/?ids={}".format(",".join(str(x) for x in ids)),
+                    headers={"Accept": "application/json"})
+            finally:
+                sqlalchemy.event.remove(
+                    self.engine, "before_cursor_execute", count)
+            self.assertEqual(status, 200)
+            self.assertEqual(len(data), len(ids))
+            return len(statements)
+
+        self.assertEqual(count_queries(ids[:1]), count_queries(ids))
+
     def test_get_mising_media(self):
         status, _, _ = self._get_response(
             "get", "/media/12345", headers={"Accept": "application/json"})
@@ -167,6 +229,116 @@ class TestMedia(flask_test.FlaskTest):
         self.assertEqual(data["filename"], match.group(1))
         self.assertTrue(response.data == content)
 
+    def test_add_media_raw(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+
+        status, headers, data = self._get_response(
+            "post", "/media/",
+            query_string={
+                "name": u"Tìtlë", "author": u"John Dôe",
+                "keywords": ["foo", "bar"], "parent_id": album.id},
+            data=content, content_type="image/jpeg",
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 201)
+        self._assert_media_equal(
+            {
+                "name": u"Tìtlë", "author": u"John Dôe",
+                "keywords": ["foo", "bar"], "parent_id": album.id,
+                "mime_type": "image/jpeg", "size": len(content)
+            },
+            data)
+
+        response = self.app.get("/media/{}/content".format(data["id"]))
+        self.assertEqual(response.headers["Content-Type"], "image/jpeg")
+        self.assertTrue(response.data == content)
+
+        # No temporary file must be left
+        self.assertEqual(
+            [x for x in os.listdir(redmill.controller.app.config["media_directory"])
+                if x.startswith(".")],
+            [])
+
+    def test_add_media_multipart(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+
+        status, _, data = self._get_response(
+            "post", "/media/",
+            data={
+                "name": u"Tìtlë", "author": u"John Dôe",
+                "parent_id": "{}".format(album.id),
+                "content": (io.BytesIO(content), "image.jpg")},
+            content_type="multipart/form-data",
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 201)
+        self._assert_media_equal(
+            {
+                "name": u"Tìtlë", "author": u"John Dôe", "parent_id": album.id,
+                "content_hash": hashlib.sha256(content).hexdigest()
+            },
+            data)
+
+        response = self.app.get("/media/{}/content".format(data["id"]))
+        self.assertTrue(response.data == content)
+
+    def test_add_media_raw_missing_field(self):
+        album = self._insert_album(u"Röôt album")
+
+        status, _, _ = self._get_response(
+            "post", "/media/",
+            query_string={"name": u"Tìtlë", "parent_id": album.id},
+            data=b"foobar", content_type="application/octet-stream",
+            headers={
+                "Accept": "application/json",
+                "Content-Transfer-Encoding": "binary"})
+        self.assertEqual(status, 400)
+
+        status, _, _ = self._get_response(
+            "post", "/media/",
+            query_string={
+                "name": u"Tìtlë", "author": u"John Dôe", "parent_id": "foo"},
+            data=b"foobar", content_type="application/octet-stream",
+            headers={
+                "Accept": "application/json",
+                "Content-Transfer-Encoding": "binary"})
+        self.assertEqual(status, 400)
+
+    def test_add_media_content_info(self):
+        album = self._insert_album(u"Röôt album")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+
+        status, _, data = self._get_response(
+            "post", "/media/",
+            data=json.dumps({
+                "name": u"Foo", "author": u"Bar", "parent_id": album.id,
+                "content": base64.b64encode(content).decode()}),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 201)
+        self.assertEqual(data["mime_type"], "image/jpeg")
+        self.assertEqual(data["size"], len(content))
+        self.assertEqual(
+            [data["width"], data["height"]],
+            list(PIL.Image.open(filename).size))
+        self.assertEqual(
+            data["content_hash"], hashlib.sha256(content).hexdigest())
+
+        status, _, html = self._get_response(
+            "get", "/media/{}".format(data["id"]),
+            headers={"Accept": "text/html"})
+        self.assertEqual(status, 200)
+        self.assertTrue(
+            "{} kB".format(len(content)//1024) in html.decode("utf-8"))
+
     def test_add_media_wrong_directory(self):
         album = self._insert_album(u"Röôt album")
 
@@ -428,6 +600,179 @@ class TestMedia(flask_test.FlaskTest):
         self.assertEqual(media["filename"], match.group(1))
         self.assertTrue(response.data.decode() == "foobar")
 
+        self.assertEqual(media["mime_type"], "text/plain")
+        self.assertEqual(media["size"], 6)
+        self.assertEqual(media["width"], None)
+        self.assertEqual(
+            media["content_hash"], hashlib.sha256(b"foobar").hexdigest())
+
+    def test_modify_media_content_streamed(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=b"foobar")
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        content = open(filename, "rb").read()
+
+        status, _, data = self._get_response(
+            "put", "/media/{}/content".format(media.id),
+            data=content, content_type="image/jpeg",
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertEqual(data["mime_type"], "image/jpeg")
+
+        response = self.app.get("/media/{}/content".format(media.id))
+        self.assertTrue(response.data == content)
+
+        status, _, data = self._get_response(
+            "put", "/media/{}/content".format(media.id),
+            data={"content": (io.BytesIO(b"foobar"), "foo.txt")},
+            content_type="multipart/form-data",
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertEqual(data["size"], 6)
+
+        response = self.app.get("/media/{}/content".format(media.id))
+        self.assertTrue(response.data == b"foobar")
+
+        status, _, _ = self._get_response(
+            "put", "/media/{}/content".format(media.id),
+            data={"foo": "bar"}, content_type="multipart/form-data",
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 400)
+
+    def test_modify_media_content_legacy(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=b"foobar")
+
+        # Base64-encoded content, whatever the type
+        for content_type in ["text/plain", "application/octet-stream"]:
+            status, _, _ = self._get_response(
+                "put", "/media/{}/content".format(media.id),
+                data=base64.b64encode(b"hello"), content_type=content_type,
+                headers={"Accept": "application/json"})
+            self.assertEqual(status, 200)
+
+            response = self.app.get("/media/{}/content".format(media.id))
+            self.assertEqual(response.data, b"hello")
+
+    def test_modify_media_content_spooled(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(u"Foo", u"Bar", album.id, content=b"foobar")
+
+        status, _, _ = self._get_response(
+            "put", "/media/{}/content".format(media.id),
+            data={
+                "content": (io.BytesIO(b"foo"), "foo.txt"),
+                "other": (io.BytesIO(b"bar"), "bar.txt")},
+            content_type="multipart/form-data",
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 200)
+
+        response = self.app.get("/media/{}/content".format(media.id))
+        self.assertEqual(response.data, b"foo")
+
+        # No remaining temporary file
+        media_directory = redmill.controller.app.config["media_directory"]
+        self.assertEqual(
+            [x for x in os.listdir(media_directory) if x.startswith(".")], [])
+
+    def test_get_media_content_conditional(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(
+            u"Foo", u"Bar", album.id, content="abcdef".encode())
+
+        etag, last_modified = redmill.views.get_content_validators(media)
+
+        status, headers, data = self._get_response(
+            "get", "/media/{}/content".format(media.id),
+            headers={"If-None-Match": "\"{}\"".format(etag)})
+        self.assertEqual(status, 304)
+        self.assertEqual(data, b"")
+        self.assertEqual(headers["ETag"], "\"{}\"".format(etag))
+
+        status, _, data = self._get_response(
+            "get", "/media/{}/content".format(media.id),
+            headers={"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        self.assertEqual(status, 304)
+
+    def test_get_media_content_range(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(
+            u"Foo", u"Bar", album.id, content="abcdefghij".encode())
+        url = "/media/{}/content".format(media.id)
+
+        response = self.app.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+        self.assertEqual(response.data, b"abcdefghij")
+
+        response = self.app.get(url, headers={"Range": "bytes=2-4"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers["Content-Range"], "bytes 2-4/10")
+        self.assertEqual(response.data, b"cde")
+
+        response = self.app.get(url, headers={"Range": "bytes=-3"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"hij")
+
+        response = self.app.get(url, headers={"Range": "bytes=20-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */10")
+
+        # Range is ignored if the content has changed
+        response = self.app.get(
+            url, headers={"Range": "bytes=2-4", "If-Range": "\"foo\""})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b"abcdefghij")
+
+        response = self.app.get(
+            url, headers={
+                "Range": "bytes=2-4", "If-Range": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 206)
+
+    def test_get_media_content_multiple_ranges(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(
+            u"Foo", u"Bar", album.id, content="abcdefghij".encode())
+
+        response = self.app.get(
+            "/media/{}/content".format(media.id),
+            headers={"Range": "bytes=0-1,5-6"})
+        self.assertEqual(response.status_code, 206)
+
+        match = re.match(
+            r"multipart/byteranges; boundary=(.*)",
+            response.headers["Content-Type"])
+        self.assertTrue(match is not None)
+        boundary = match.group(1)
+
+        self.assertEqual(
+            int(response.headers["Content-Length"]), len(response.data))
+
+        parts = response.data.decode().split("--{}".format(boundary))
+        self.assertEqual(parts[0], "")
+        self.assertEqual(parts[-1], "--\r\n")
+        self.assertTrue(parts[1].endswith("bytes 0-1/10\r\n\r\nab\r\n"))
+        self.assertTrue(parts[2].endswith("bytes 5-6/10\r\n\r\nfg\r\n"))
+
+    def test_get_media_content_sendfile(self):
+        album = self._insert_album(u"Röôt album")
+        media = self._insert_media(
+            u"Foo", u"Bar", album.id, content="abcdefghij".encode())
+
+        config = redmill.controller.app.config
+        config["sendfile"] = "X-Accel-Redirect"
+        try:
+            response = self.app.get("/media/{}/content".format(media.id))
+        finally:
+            config["sendfile"] = None
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(
+            response.headers["X-Accel-Redirect"],
+            "/media_directory/{}".format(media.id))
+
     def test_put_media(self):
         album = self._insert_album(u"Röôt album")
         media = self._insert_media(
@@ -0,0 +1,226 @@
+# encoding: utf-8
+
+# This file is part of Redmill.
+#
+# Redmill is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Redmill is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Redmill.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sys
+import unittest
+
+import sqlalchemy
+
+import redmill
+import redmill.views
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import flask_test
+
+class TestUploadSession(flask_test.FlaskTest):
+    def setUp(self):
+        flask_test.FlaskTest.setUp(self)
+        redmill.controller.app.config["authenticator"] = lambda x: True
+        redmill.controller.app.debug = True
+
+        filename = os.path.join(os.path.dirname(__file__), "..", "image.jpg")
+        self.content = open(filename, "rb").read()
+
+    def test_upload(self):
+        album = self._insert_album(u"Röôt album")
+        upload = self._create(album.id)
+
+        # Send the chunks in reverse order
+        chunk_size = len(self.content)//3+1
+        offsets = list(range(0, len(self.content), chunk_size))
+        for offset in reversed(offsets):
+            status, _, data = self._put_chunk(
+                upload["id"], offset, offset+chunk_size)
+            self.assertEqual(status, 200)
+            self.assertEqual(
+                data["received"], [[offset, len(self.content)-1]])
+
+        status, _, data = self._get_response(
+            "get", "/uploads/{}".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertTrue(data["complete"])
+
+        status, headers, media = self._get_response(
+            "post", "/uploads/{}/finalize".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 201)
+        self._assert_media_equal(
+            {
+                "name": u"Tìtlë", "author": u"John Dôe",
+                "keywords": ["foo", "bar"], "parent_id": album.id,
+                "mime_type": "image/jpeg", "size": len(self.content),
+                "content_hash": hashlib.sha256(self.content).hexdigest()
+            },
+            media)
+
+        response = self.app.get("/media/{}/content".format(media["id"]))
+        self.assertTrue(response.data == self.content)
+
+        status, _, _ = self._get_response(
+            "get", "/uploads/{}".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 404)
+
+    def test_received(self):
+        album = self._insert_album(u"Röôt album")
+        upload = self._create(album.id)
+
+        self._put_chunk(upload["id"], 100, 200)
+        self._put_chunk(upload["id"], 0, 50)
+        status, _, data = self._put_chunk(upload["id"], 50, 100)
+        self.assertEqual(status, 200)
+        self.assertEqual(data["received"], [[0, 199]])
+
+        # Resending a chunk is allowed
+        status, _, data = self._put_chunk(upload["id"], 300, 400)
+        status, _, data = self._put_chunk(upload["id"], 300, 400)
+        self.assertEqual(status, 200)
+        self.assertEqual(data["received"], [[0, 199], [300, 399]])
+        self.assertFalse(data["complete"])
+
+        status, _, _ = self._get_response(
+            "post", "/uploads/{}/finalize".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 409)
+
+    def test_finalize_failure(self):
+        album = self._insert_album(u"Röôt album")
+        upload = self._create(album.id)
+        self._put_chunk(upload["id"], 0, len(self.content))
+
+        def fail(session):
+            raise Exception("Commit failure")
+        sqlalchemy.event.listen(redmill.database.Session, "before_commit", fail)
+        try:
+            status, _, _ = self._get_response(
+                "post", "/uploads/{}/finalize".format(upload["id"]),
+                headers={"Accept": "application/json"})
+        finally:
+            sqlalchemy.event.remove(
+                redmill.database.Session, "before_commit", fail)
+        self.assertEqual(status, 500)
+
+        # The upload session and its content are kept
+        status, _, data = self._get_response(
+            "get", "/uploads/{}".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertTrue(data["complete"])
+
+        status, _, _ = self._get_response(
+            "post", "/uploads/{}/finalize".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 201)
+
+    def test_wrong_range(self):
+        album = self._insert_album(u"Röôt album")
+        upload = self._create(album.id)
+        url = "/uploads/{}".format(upload["id"])
+
+        status, _, _ = self._get_response("put", url, data=b"foo")
+        self.assertEqual(status, 400)
+
+        status, _, _ = self._get_response(
+            "put", url, data=b"foo",
+            headers={"Content-Range": "bytes 0-2/{}".format(
+                len(self.content)+1)})
+        self.assertEqual(status, 400)
+
+        # No range
+        status, _, _ = self._get_response(
+            "put", url, data=b"foo",
+            headers={"Content-Range": "bytes */{}".format(len(self.content))})
+        self.assertEqual(status, 400)
+
+        # Incomplete chunk
+        status, _, _ = self._get_response(
+            "put", url, data=b"foo", headers={"Content-Range": "bytes 0-9/*"})
+        self.assertEqual(status, 400)
+
+        status, _, data = self._get_response(
+            "get", url, headers={"Accept": "application/json"})
+        self.assertEqual(data["received"], [])
+
+    def test_wrong_album(self):
+        album = self._insert_album(u"Röôt album")
+
+        status, _, _ = self._get_response(
+            "post", "/uploads/",
+            data=json.dumps({
+                "name": u"Foo", "author": u"Bar", "parent_id": album.id+1,
+                "size": 10}),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 404)
+
+    def test_missing_field(self):
+        album = self._insert_album(u"Röôt album")
+
+        status, _, _ = self._get_response(
+            "post", "/uploads/",
+            data=json.dumps({
+                "name": u"Foo", "author": u"Bar", "parent_id": album.id}),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 400)
+
+    def test_delete(self):
+        album = self._insert_album(u"Röôt album")
+        upload = self._create(album.id)
+        self._put_chunk(upload["id"], 0, 100)
+
+        status, _, _ = self._get_response(
+            "delete", "/uploads/{}".format(upload["id"]))
+        self.assertEqual(status, 204)
+
+        status, _, _ = self._get_response(
+            "get", "/uploads/{}".format(upload["id"]),
+            headers={"Accept": "application/json"})
+        self.assertEqual(status, 404)
+        self.assertEqual(
+            os.listdir(redmill.controller.app.config["media_directory"]), [])
+
+    def _create(self, parent_id):
+        status, headers, data = self._get_response(
+            "post", "/uploads/",
+            data=json.dumps({
+                "name": u"Tìtlë", "author": u"John Dôe",
+                "keywords": ["foo", "bar"], "parent_id": parent_id,
+                "size": len(self.content)}),
+            headers={"Accept": "application/json"})
+
+        self.assertEqual(status, 201)
+        self.assertTrue("Location" in headers)
+        self.assertEqual(data["received"], [])
+        self.assertFalse(data["complete"])
+
+        return data
+
+    def _put_chunk(self, id_, start, stop):
+        stop = min(stop, len(self.content))
+        return self._get_response(
+            "put", "/uploads/{}".format(id_),
+            data=self.content[start:stop],
+            headers={
+                "Content-Range": "bytes {}-{}/{}".format(
+                    start, stop-1, len(self.content)),
+                "Accept": "application/json"})
+
+if __name__ == "__main__":
+    unittest.main()